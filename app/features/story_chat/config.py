@@ -1,8 +1,11 @@
 # version2/config.py
 import os
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 # Load env vars
 load_dotenv()
@@ -12,18 +15,94 @@ load_dotenv()
 # ────────────────────────────
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MAX_HISTORY = 20
+# Request size guards: whole body (checked before parsing) and one entity image
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(5_000_000)))
+MAX_ENTITY_IMAGE_CHARS = int(os.getenv("MAX_ENTITY_IMAGE_CHARS", str(2_000_000)))   # base64
+# Approximate token budget (chars / 4) for the history sent to the models;
+# older turns beyond it are folded into a short summary message.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+
+# Max in-flight image generations per process
+OPENAI_IMAGE_CONCURRENCY = int(os.getenv("OPENAI_IMAGE_CONCURRENCY", "4"))
+
+# Lifetime of memoised OpenAI results (decisions, pages, image prompts)
+OPENAI_CACHE_TTL = int(os.getenv("OPENAI_CACHE_TTL", "3600"))   # seconds
+
+# How long a /chat response is replayed for retries carrying the same
+# `Idempotency-Key` header (requests without one are never cached); 0 = off
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))   # seconds
+
+# Reuse pages written for a prompt at least this similar (cosine, e.g. 0.95); 0 = off
+PAGES_SEMANTIC_THRESHOLD = float(os.getenv("PAGES_SEMANTIC_THRESHOLD", "0"))
+
+# Proactive per-process rate limits (0 = off), see core/rate_limit.py
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))              # chat requests / minute
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))              # chat tokens / minute
+OPENAI_IMAGE_RPM = float(os.getenv("OPENAI_IMAGE_RPM", "0"))  # image requests / minute
+
+# Generated images handed out as `/images/{uid}` URLs
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "cache/generated")
+IMAGE_STORE_TTL = int(os.getenv("IMAGE_STORE_TTL", "3600"))   # seconds
+
+# Persistent cache of image generation results, LRU-evicted past the budget
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "cache/images")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(10 * 1024**3)))
 
 # ────────────────────────────
 # ░░ OpenAI Client ░░
 # ────────────────────────────
-client = OpenAI(api_key=OPENAI_API_KEY)
+# One pooled HTTP/2 connection set for all SDK calls of this process, sized
+# for many concurrent chat turns. The SDK's own client class keeps its default
+# timeout (10 min read), which long non-streamed completions need.
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    ),
+)
+
+# Pooled keep-alive client for the multipart `/images/edits` call, which we
+# issue directly. Auth header and TLS session are set up once, not per image;
+# over HTTP/2 concurrent edits multiplex on the same connection.
+image_http_client = httpx.AsyncClient(
+    base_url="https://api.openai.com/v1",
+    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+    http2=True,
+    timeout=300,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+)
 
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    level=LOG_LEVEL,
-)
+
+# While the app runs, request handlers only enqueue records and a background
+# thread does the blocking write to stderr, so a slow pipe never stalls the
+# event loop. Outside the app (scripts, tests) records go straight to stderr.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))   # merge args; final format is on the stream
+logging.basicConfig(level=LOG_LEVEL, handlers=[_stream_handler])
+
+_log_listener = QueueListener(_log_queue, _stream_handler)
+
+
+def start_log_listener() -> None:
+    """Route root logging through the queue; called on app startup."""
+    _log_listener.start()
+    root = logging.getLogger()
+    root.removeHandler(_stream_handler)
+    root.addHandler(_queue_handler)
+
+
+def stop_log_listener() -> None:
+    """Flush the queue and log to stderr directly again; called on shutdown."""
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    root.addHandler(_stream_handler)
+    _log_listener.stop()
 
 logger = logging.getLogger("storygpt")
 logger.info("Logging initialised at %s level", LOG_LEVEL)
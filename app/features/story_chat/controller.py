@@ -1,57 +1,219 @@
 # app/features/story_chat/controller.py
 
-from fastapi import HTTPException
+import asyncio
+from collections import deque
+from graphlib import TopologicalSorter
+import orjson
+from fastapi import HTTPException, Response
+from anyio import to_thread
+from fastapi.responses import FileResponse, StreamingResponse
 from openai import OpenAIError
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from .core.schemas import ChatRequest, ChatResponse, Story, StoryEntity, Mode
 from .core.tool_agent import _tool_agent
-from .core.actions import _apply_tool
-from .config import logger, MAX_HISTORY
+from .core.actions import _apply_tool, _tool_resources, IMAGE_TOOLS
+from .core.entity_store import EntityStore
+from .core.image_store import find_image
+from .core.cache import AsyncLRUCache, content_key
+from .config import logger, MAX_HISTORY, HISTORY_TOKEN_BUDGET, RESPONSE_CACHE_TTL
 from .core.reply_agent  import reply_agent
-from app.features.story_chat.core.utils import ( history_for_api )
+from app.features.story_chat.core.utils import ( history_for_api, split_summary, compact_history, _ensure_image_slot, _page_listener )
 
-async def handle_chat(req: ChatRequest) -> ChatResponse:
+# Mode(value) scans the members; a dict lookup does not
+_MODE_BY_VALUE: Dict[str, Mode] = {m.value: m for m in Mode}
+
+# Tools that write `story.images[index]`
+_IMAGE_SLOT_TOOLS = {"edit_image_prompt", "generate_image_for_index"}
+
+# Retries of one request (same client `Idempotency-Key`) within the TTL get the
+# first response. Turns that made images are not kept: their URLs expire and
+# X-Cache belongs to the first call.
+_RESPONSE_CACHE: AsyncLRUCache[ChatResponse] = AsyncLRUCache("chat_response", maxsize=1024, ttl=RESPONSE_CACHE_TTL)
+
+
+def _conflicts(a: Tuple[frozenset, frozenset], b: Tuple[frozenset, frozenset]) -> bool:
+    """True if two calls touch the same state and at least one of them writes it."""
+    (reads_a, writes_a), (reads_b, writes_b) = a, b
+    return bool(writes_a & (reads_b | writes_b) or writes_b & reads_a)
+
+
+async def _run_tool_calls(
+    tool_calls: List[Tuple[str, dict]],
+    story: Story,
+    entities: EntityStore,
+) -> List[Dict]:
+    """Apply *tool_calls* and return their results in call order.
+
+    Calls that touch the same state (see `_tool_resources`) run in the order
+    the model gave them; everything else runs concurrently, so e.g. a page
+    regeneration and images for other pages overlap.
+    """
+    results: Dict[int, Dict] = {}
+
+    # Size the image list once up front; the per-tool `_ensure_image_slot`
+    # calls then only re-grow it if a truncate ran in between.
+    max_idx = max(
+        (
+            args["index"]
+            for tool, args in tool_calls
+            if tool in _IMAGE_SLOT_TOOLS and isinstance(args.get("index"), int)
+        ),
+        default=-1,
+    )
+    if max_idx >= 0:
+        _ensure_image_slot(story, max_idx)
+
+    # Each call depends on every earlier call it conflicts with
+    resources = [_tool_resources(*call) for call in tool_calls]
+    sorter: TopologicalSorter = TopologicalSorter()
+    for i in range(len(tool_calls)):
+        sorter.add(i, *(j for j in range(i) if _conflicts(resources[j], resources[i])))
+    sorter.prepare()
+
+    async def run(i: int) -> None:
+        tool, args = tool_calls[i]
+        logger.info(">> Executing tool: %s %s", tool, args)
+        results[i] = await _apply_tool(tool, args, story, entities)
+
+    # Start each call as soon as its dependencies are done
+    running: Dict[asyncio.Task, int] = {}
+    try:
+        while sorter.is_active():
+            for i in sorter.get_ready():
+                running[asyncio.create_task(run(i))] = i
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()                    # surface the tool's HTTPException
+                sorter.done(running.pop(task))
+    finally:
+        for task in running:
+            task.cancel()
+        # Wait for the cancellations, so no call keeps mutating the story
+        # after we return and no exception goes unretrieved
+        await asyncio.gather(*running, return_exceptions=True)
+
+    return [results[i] for i in range(len(tool_calls))]
+
+
+async def handle_chat(
+    req: ChatRequest,
+    response: Optional[Response] = None,
+    idempotency_key: Optional[str] = None,
+) -> ChatResponse:
+    logger.info("New /chat request: user_input=%.80r", req.user_input)
+    if not (RESPONSE_CACHE_TTL and idempotency_key):
+        return await _handle_chat(req, response)
+    key = content_key("chat", idempotency_key)
+    result = await _RESPONSE_CACHE.get_or_compute(key, lambda: _handle_chat(req, response))
+    if any(m.value in IMAGE_TOOLS for m in result.modes):
+        _RESPONSE_CACHE.discard(key)
+    return result
+
+
+async def _handle_chat(req: ChatRequest, response: Optional[Response] = None) -> ChatResponse:
     story: Story = req.story or Story(prompt="")
-    entities: List[StoryEntity] = list(req.entities or [])
-    history_with_tools: List[dict] = list(req.history or [])
+    # `req` is parsed fresh for every call, so its lists are ours to mutate –
+    # no defensive copies needed. The store adds O(1) lookups by name.
+    entities = EntityStore(req.entities or [])
     user_msg = req.user_input
-    history = history_for_api(history_with_tools)
+    # The window is enforced on append; oldest turns fall off in O(1). The
+    # summary of older turns lives outside it, so it is never pushed out.
+    summary, turns = split_summary(history_for_api(req.history or []))
+    history = deque(turns, maxlen=MAX_HISTORY)
 
     # ── 1. Add the latest user turn ───────────────────────────────────────
     history.append({"role": "user", "content": user_msg})
+    summary = compact_history(history, HISTORY_TOKEN_BUDGET, summary)
+    prompt_history = [summary, *history] if summary else list(history)
 
     try:
-        tool_calls = _tool_agent(story, entities, history)
+        tool_calls = await _tool_agent(story, entities, prompt_history)
     except OpenAIError as e:
         logger.error("OpenAI call failed: %s", str(e))
         raise HTTPException(502, f"OpenAI error: {str(e)}")
 
     executed_tools: List[Mode] = []
     extras = {}
+    image_cache_status: List[str] = []
 
     story_before = Story(**story.model_dump())
 
-    for tool, args in tool_calls:          # tool_calls is never empty now
-        logger.info(">> Executing tool: %s %s", tool, args)
-        action_result = _apply_tool(tool, args, story, entities)
-        executed_tools.append(Mode(tool))
+    results = await _run_tool_calls(tool_calls, story, entities)
+    for (tool, _), action_result in zip(tool_calls, results):   # tool_calls is never empty now
+        executed_tools.append(_MODE_BY_VALUE.get(tool, Mode.NO_TOOL))
+        if "image_cache" in action_result:
+            image_cache_status.append(action_result.pop("image_cache"))
         extras.update(action_result)
 
+    # One HIT/MISS entry per generated image, e.g. "X-Cache: HIT, MISS"
+    if response is not None and image_cache_status:
+        response.headers["X-Cache"] = ", ".join(image_cache_status)
+
     # ───────────────────────────────────────────
     # 2️⃣  HUMAN-LANGUAGE ANSWER
     # ───────────────────────────────────────────
-    assistant_output = reply_agent(req.user_input, story_before, story, entities, history, tool_calls)
+    assistant_output = await reply_agent(req.user_input, story_before, story, entities, prompt_history, tool_calls)
 
     history.append({"role": "assistant", "content": assistant_output})
 
-    print("Returning response with mode:", executed_tools)
+    logger.debug("Returning response with modes: %s", executed_tools)
     return ChatResponse(
         modes=executed_tools,
         assistant_output=assistant_output,
         story=story,
-        entities=entities,
-        history=history,
+        entities=entities.items,
+        history=[summary, *history] if summary else list(history),
         image_b64=extras.get("image_b64"),
+        image_url=extras.get("image_url"),
         settings = story.settings,
     )
+
+
+def _sse(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+async def handle_chat_stream(req: ChatRequest, idempotency_key: Optional[str] = None) -> StreamingResponse:
+    """`/chat` as server-sent events.
+
+    Regenerated pages are sent as `page` events while the model writes them,
+    followed by one `result` event with the full `ChatResponse` (or an `error`
+    event). Pages served from a cache only appear in the result.
+    """
+    queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue()
+
+    def on_page(index: int, text: str, image_prompt: str) -> None:
+        queue.put_nowait(_sse("page", orjson.dumps({"index": index, "text": text, "image_prompt": image_prompt})))
+
+    async def run() -> None:
+        _page_listener.set(on_page)          # only this task and the tasks it starts
+        try:
+            result = await handle_chat(req, idempotency_key=idempotency_key)
+            queue.put_nowait(_sse("result", result.model_dump_json().encode()))
+        except HTTPException as e:
+            queue.put_nowait(_sse("error", orjson.dumps({"status": e.status_code, "detail": e.detail})))
+        except Exception:
+            logger.exception("/chat/stream failed")
+            queue.put_nowait(_sse("error", orjson.dumps({"status": 500, "detail": "Internal Server Error"})))
+        finally:
+            queue.put_nowait(None)
+
+    async def events() -> AsyncIterator[bytes]:
+        task = asyncio.create_task(run())
+        try:
+            while (event := await queue.get()) is not None:
+                yield event
+        finally:
+            task.cancel()                    # no-op once done; stops work for a client that left
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def handle_get_image(uid: str) -> Response:
+    found = await to_thread.run_sync(find_image, uid)
+    if found is None:
+        raise HTTPException(404, "Image not found or expired.")
+    path, st = found
+    # Streamed from disk in chunks on worker threads, not read into memory
+    return FileResponse(path, media_type="image/png", stat_result=st)
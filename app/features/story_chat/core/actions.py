@@ -1,4 +1,4 @@
-from app.features.story_chat.core.utils import (_parse_json_or_lines, _clean_json_fence, _normalize_indexes, _find_entity, _summarise_images)
+from app.features.story_chat.core.utils import (_parse_json_or_lines, _clean_json_fence, _normalize_indexes, _summarise_images, _generate_story_pages, _generate_image_prompts, _ensure_image_slot, _set_page_texts, _top_up_pages)
 from .schemas import (
     Story,
     StorySettings,
@@ -9,28 +9,143 @@ from .schemas import (
     Mode,
     StoryImage,
 )
-from typing import Dict, List, Optional, Tuple
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+import binascii
 import httpx
-from ..config import (logger, client, MAX_HISTORY)
-import base64
-from io import BytesIO
+import orjson
+from pydantic import TypeAdapter, ValidationError
+from openai import APIConnectionError, InternalServerError, OpenAIError, RateLimitError
+from tenacity import RetryCallState, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from .entity_store import EntityStore
+from .image_store import store_image, image_url
+from .image_cache import image_cache_key, load_cached_image, store_cached_image
+from .rate_limit import image_limiter, pause_on_429, retry_after_seconds
+from ..config import (logger, client, image_http_client, MAX_HISTORY, OPENAI_IMAGE_CONCURRENCY)
 from fastapi import FastAPI, HTTPException
 
 
 # ────────────────────────────
 # ░░ Apply actions ░░
 # ────────────────────────────
-def _generate_image(
+# Tools that call the image model; independent of each other within a turn
+IMAGE_TOOLS = {"generate_image_for_index", "generate_image"}
+
+# Tools that may change `story.images` (invalidates its cached summary)
+_STORY_IMAGE_TOOLS = {
+    "edit_story_prompt",
+    "truncate_to_page_count",
+    "edit_image_prompt",
+    "generate_image_prompts_bulk",
+    "generate_image_for_index",
+}
+
+# Parts of the story state a tool reads / writes, used to decide which calls
+# of one turn may run concurrently. A single page image is `("image", index)`;
+# writing it also reads the list itself, so it is ordered against tools that
+# reshape the whole `images` list but not against other pages.
+_ALL_STATE = frozenset({"prompt", "settings", "title", "genre", "keywords", "pages", "images", "entities"})
+_TOOL_RESOURCES: Dict[str, Tuple[FrozenSet, FrozenSet]] = {
+    "no_tool":                     (frozenset(), frozenset()),
+    "edit_target_page_count":      (frozenset(), frozenset({"settings"})),
+    "edit_story_tone":             (frozenset(), frozenset({"settings"})),
+    "truncate_to_page_count":      (frozenset({"settings"}), frozenset({"pages", "images"})),
+    "edit_story_title":            (frozenset(), frozenset({"title"})),
+    "edit_story_genre":            (frozenset(), frozenset({"genre"})),
+    "edit_story_keywords":         (frozenset(), frozenset({"keywords"})),
+    "edit_text":                   (frozenset(), frozenset({"pages"})),
+    "edit_all":                    (frozenset(), frozenset({"pages"})),
+    "insert_page":                 (frozenset(), frozenset({"pages"})),
+    "delete_page":                 (frozenset(), frozenset({"pages"})),
+    "move_page":                   (frozenset(), frozenset({"pages"})),
+    "add_entity":                  (frozenset(), frozenset({"entities"})),
+    "update_entity":               (frozenset(), frozenset({"entities"})),
+    "delete_entity":               (frozenset(), frozenset({"entities"})),
+    "generate_image_prompts_bulk": (frozenset({"pages", "entities"}), frozenset({"images"})),
+    "generate_image":              (frozenset({"entities"}), frozenset()),
+}
+
+
+def _tool_resources(tool: str, data: dict) -> Tuple[FrozenSet, FrozenSet]:
+    """Return `(reads, writes)` of one tool call; unknown tools touch everything."""
+    if tool == "edit_story_prompt":
+        if data.get("regenerate_pages") or data.get("new_pages"):
+            return (
+                frozenset({"prompt", "settings", "entities"}),
+                frozenset({"prompt", "pages", "images"}),
+            )
+        return frozenset(), frozenset({"prompt"})
+    if tool in ("edit_image_prompt", "generate_image_for_index"):
+        reads = {"images", "entities"} if tool == "generate_image_for_index" else {"images"}
+        return frozenset(reads), frozenset({("image", data.get("index"))})
+    return _TOOL_RESOURCES.get(tool, (_ALL_STATE, _ALL_STATE))
+
+# Caps in-flight image calls across all requests to stay under OpenAI's RPM
+_IMAGE_SEMAPHORE = asyncio.Semaphore(OPENAI_IMAGE_CONCURRENCY)
+
+
+# Retries for image calls are handled by `_request_image`, not by the SDK
+_image_client = client.with_options(max_retries=0)
+
+
+# Validate whole lists of model-supplied values in one pydantic-core call
+_PAGE_TEXTS = TypeAdapter(List[str])
+_PAGE_INDEXES = TypeAdapter(List[int])
+
+
+def _inline_pages(items: List[Any]) -> Tuple[List[str], List[str]]:
+    """`new_pages` of an `edit_story_prompt` call → `(texts, image_prompts)`."""
+    texts: List[str] = []
+    image_prompts: List[str] = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"text": item}
+        text = str(item.get("text") or "").strip() if isinstance(item, dict) else ""
+        if text:
+            texts.append(text)
+            image_prompts.append(str(item.get("image_prompt") or "").strip())
+    if not texts:
+        raise HTTPException(400, "edit_story_prompt: new_pages holds no page text")
+    return texts, image_prompts
+
+
+class _RetryableImageError(Exception):
+    """429 / 5xx from the image edits endpoint – worth another attempt."""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(response.text)
+        self.response = response
+
+
+_backoff = wait_random_exponential(max=30)
+
+
+def _wait_for_retry(retry_state: RetryCallState) -> float:
+    """Jittered exponential backoff, but never sooner than the `Retry-After`
+    the server sent with the failed attempt."""
+    wait = _backoff(retry_state)
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None and "retry-after" in response.headers:
+        wait = max(wait, retry_after_seconds(response.headers))
+    return wait
+
+
+async def _generate_image(
     *,
     prompt: str,
     entity_names: List[str],
-    entities: List[StoryEntity],
+    entities: EntityStore,
     size: str = "1024x1024",
     quality: str = "low",
-) -> str:                     # returns image_b64    image_files = [BytesIO(base64.b64decode(e.b64_json)) for e in used_entities if e.b64_json]
+    fresh: bool = False,       # explicit regenerate: skip the cache lookup
+) -> Tuple[bytes, bool]:       # returns (raw PNG bytes, served from cache)
     
     used_entities = [e for e in entities if e.name in entity_names]
-    image_files = [BytesIO(base64.b64decode(e.b64_json)) for e in used_entities if e.b64_json]
+    # Raw bytes go straight into the multipart body – no BytesIO wrapper needed
+    try:
+        image_files = [e.raw_image for e in used_entities if e.b64_json]
+    except binascii.Error:
+        raise HTTPException(400, "An entity image is not valid base64.")
     
     text_prompts = []
     for e in entities:
@@ -44,232 +159,361 @@ def _generate_image(
     if text_prompts:
         prompt += "\n\n" + "\n".join(text_prompts)
 
-    if image_files:
-        # Send as multipart/form-data
-        files = []
-        for i, f in enumerate(image_files):
-            files.append(("image[]", ("entity_image_%d.png" % i, f, "image/png")))
-
-        data = {
-            "model": "gpt-image-1",
-            "prompt": prompt,
-            "quality": "low",
-            "size": "1024x1024"
-        }
-
-        headers = {
-            "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"
-        }
-
-        response = httpx.post(
-            "https://api.openai.com/v1/images/edits",
-            headers=headers,
-            data=data,
-            files=files,
-            timeout=300
-        )
+    if not image_files and not text_prompts:
+        raise HTTPException(400, "No valid image files or prompts provided for image generation.")
 
-        if response.status_code != 200:
-            logger.error("Image generation failed: %s", response.text)
-            raise HTTPException(502, "Image generation failed: " + response.text)
+    cache_key = image_cache_key(prompt, size, quality, image_files)
+    cached = None if fresh else await load_cached_image(cache_key)
+    if cached is not None:
+        logger.info("Image cache HIT %s", cache_key[:12])
+        return cached, True
+    logger.info("Image cache MISS %s", cache_key[:12])
+
+    try:
+        image_b64 = await _request_image(prompt, image_files, size, quality)
+    except (_RetryableImageError, httpx.TransportError, OpenAIError) as e:
+        logger.error("Image generation failed: %s", e)
+        raise HTTPException(502, f"Image generation failed: {e}")
+
+    raw = binascii.a2b_base64(image_b64)
+    await store_cached_image(cache_key, raw)
+    return raw, False
+
+
+@retry(
+    retry=retry_if_exception_type(
+        (_RetryableImageError, httpx.TransportError, APIConnectionError, RateLimitError, InternalServerError)
+    ),
+    wait=_wait_for_retry,
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def _request_image(prompt: str, image_files: List[bytes], size: str, quality: str) -> str:
+    """Call the image model; returns the base64 payload of the first image."""
+    await image_limiter.acquire()
+    # Held for this attempt only, never across the retry backoff
+    async with _IMAGE_SEMAPHORE:
+        if image_files:
+            # Send as multipart/form-data
+            files = []
+            for i, raw in enumerate(image_files):
+                files.append(("image[]", ("entity_image_%d.png" % i, raw, "image/png")))
+
+            data = {
+                "model": "gpt-image-1",
+                "prompt": prompt,
+                "quality": quality,
+                "size": size,
+            }
+
+            response = await image_http_client.post("/images/edits", data=data, files=files)
+
+            if response.status_code == 429:
+                image_limiter.block(retry_after_seconds(response.headers))
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.warning("Image edit returned %d, retrying", response.status_code)
+                raise _RetryableImageError(response)
+            if response.status_code != 200:
+                logger.error("Image generation failed: %s", response.text)
+                raise HTTPException(502, "Image generation failed: " + response.text)
+
+            return orjson.loads(response.content)["data"][0]["b64_json"]
 
-        image_b64 = response.json()["data"][0]["b64_json"]
-        return image_b64
+        else:
+            # No images, generate from text only
+            with pause_on_429(image_limiter):
+                result = await _image_client.images.generate(
+                    model="gpt-image-1",
+                    prompt=prompt,
+                    n=1,
+                    size=size,
+                    quality=quality,
+                )
+            return result.data[0].b64_json
+
+
+# ---------------------------------------------------------------------------
+# Tool handlers – each mutates *story* / *entities* in place and may return
+# extras for the response
+# ---------------------------------------------------------------------------
+ToolHandler = Callable[[dict, Story, EntityStore], Awaitable[Optional[Dict]]]
+
+
+# Page / story tools
+async def _edit_story_prompt(data: dict, story: Story, entities: EntityStore) -> None:
+    story.prompt = data["new_prompt"]
+
+    if data.get("regenerate_pages") or data.get("new_pages"):
+        if data.get("new_pages"):
+            # The decider already wrote the pages – skip the second round-trip
+            texts, image_prompts = _inline_pages(data["new_pages"])
+            # Same page-count policy as the page writer
+            await _top_up_pages(story, entities, texts, image_prompts)
+        else:
+            # One call returns every page together with its image prompt
+            texts, image_prompts = await _generate_story_pages(
+                story, entities, fresh=bool(data.get("regenerate_pages"))
+            )
+        _set_page_texts(story, texts)
+        story.images = [
+            StoryImage.model_construct(index=i, prompt=p or None)
+            for i, p in enumerate(image_prompts)
+        ]
 
-    elif text_prompts:
-        # No images, generate from text only
-        result = client.images.generate(
-            model="gpt-image-1",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            quality="low",
-        )
-        return result.data[0].b64_json
 
-    else:
-        raise HTTPException(400, "No valid image files or prompts provided for image generation.")
+async def _edit_target_page_count(data: dict, story: Story, entities: EntityStore) -> None:
+    if story.settings is None:
+        story.settings = StorySettings()
+    story.settings.target_page_count = data["target_page_count"]
 
 
-def _apply_tool(
-    tool: str,
-    data: dict,
-    story: Story,
-    entities: List[StoryEntity],
-) -> Dict:
-    """Mutate *story* and *entities* in‑place according to the tool call."""
+async def _truncate_to_page_count(data: dict, story: Story, entities: EntityStore) -> None:
+    target = story.settings.target_page_count or len(story.pages)
+    story.pages = story.pages[:target]
+    story.images = story.images[:target]
+    _normalize_indexes(story)
 
-    extras: Dict = {}
 
-    # Page / story tools
-    if tool == "edit_story_prompt":
-        new_prompt = data["new_prompt"]
-        story.prompt = new_prompt
-
-    elif tool == "edit_target_page_count":
-        if story.settings is None:
-            story.settings = StorySettings()
-        story.settings.target_page_count = data["target_page_count"]
-    elif tool == "truncate_to_page_count":
-        target = story.settings.target_page_count or len(story.pages)
-        story.pages = story.pages[:target]
-        story.images = story.images[:target]
-        _normalize_indexes(story)
-
-    elif tool == "edit_story_tone":
-        if story.settings is None:
-            story.settings = StorySettings()
-        story.settings.tone = data["tone"]
-
-    elif tool == "edit_story_title":
-        story.title = data["title"]
-
-    elif tool == "edit_story_genre":
-        story.genre = data["genre"]
-
-    elif tool == "edit_story_keywords":
-        story.keywords = data["keywords"]
-
-    elif tool == "no_tool":
-        # deliberate no-op
-        pass
-
-    elif tool == "edit_image_prompt":
-        # The only job here is to update the stored metadata of ONE page-image.
-        # Absolutely no story text or page list should change.
-
-        idx      = data["index"]          # zero-based page index
-        new_p    = data.get("prompt")    # may be None
-        new_size = data.get("size")      # may be None
-        new_q    = data.get("quality")   # may be None
-
-        # Ensure the images list is long enough to hold this page slot
-        if len(story.images) <= idx:
-            story.images.extend([None] * (idx + 1 - len(story.images)))
-
-        # If the slot is empty, create a minimal StoryImage shell first
-        if story.images[idx] is None:
-            story.images[idx] = StoryImage(index=idx)
-
-        img_cfg = story.images[idx]
-
-        # Apply only the fields the user provided
-        if new_p is not None:
-            img_cfg.prompt = new_p
-        if new_size is not None:
-            img_cfg.size = new_size
-        if new_q is not None:
-            img_cfg.quality = new_q
-
-    elif tool == "edit_text":
-        idx = data["index"]
-        if not 0 <= idx <= len(story.pages):
-            logger.warning("Page index %d out of bounds for edit_text. Page count: %d", idx, len(story.pages))
-            raise HTTPException(400, "Page index out of range.")
-        logger.info("✏️ Editing text on page %d", idx)
-        story.pages[idx].text = data["new_text"]
-
-    elif tool == "edit_all":
-        new_texts = data["new_texts"]
-        story.pages = [StoryText(index=i, text=t) for i, t in enumerate(new_texts)]
-        _normalize_indexes(story)
-
-    elif tool == "insert_page":
-        idx = data["index"]
-        text = data["text"]
-        if not 0 <= idx <= len(story.pages):
-            raise HTTPException(400, "Insert index out of range.")
-        story.pages.insert(idx, StoryText(index=idx, text=text))
-        _normalize_indexes(story)
-
-    elif tool == "delete_page":
-        idx = data["index"]
-        if not 0 <= idx < len(story.pages):
-            raise HTTPException(400, "Delete index out of range.")
-        story.pages.pop(idx)
-        _normalize_indexes(story)
-
-    elif tool == "move_page":
-        frm, to = data["from_index"], data["to_index"]
-        if not (0 <= frm < len(story.pages)) or not (0 <= to < len(story.pages)):
-            raise HTTPException(400, "Move indexes out of range.")
-        page = story.pages.pop(frm)
-        story.pages.insert(to, page)
-        _normalize_indexes(story)
-
-    # Entity tools
-    elif tool == "add_entity":
-        name = data["name"]
-        if _find_entity(name, entities):
-            # Silently turn it into an update instead of bombing out
-            tool = "update_entity"
-            data = {"name": name, **data}
-        entities.append(StoryEntity(**data))
-
-    elif tool == "update_entity":
-        ent = _find_entity(data["name"], entities)
-        if ent is None:
-            raise HTTPException(404, "Entity not found.")
-        if "new_name" in data and data["new_name"]:
-            if _find_entity(data["new_name"], entities):
-                raise HTTPException(400, f"Entity '{data['new_name']}' already exists.")
-            ent.name = data["new_name"]
-        if "b64_json" in data:
-            ent.b64_json = data["b64_json"]
-        if "prompt" in data:
-            ent.prompt = data["prompt"]
-
-    elif tool == "delete_entity":
-        ent = _find_entity(data["name"], entities)
-        if ent is None:
-            raise HTTPException(404, "Entity not found.")
-        entities.remove(ent)
-
-    elif tool == "generate_image_for_index":
-        page_idx      = data["index"]
-        prompt        = data["prompt"]
-        entity_names  = data.get("entity_names", [])
-        size    = data.get("size", "1024x1024")
-        quality = data.get("quality", "low")
-
-        image_b64 = _generate_image(
-                prompt=prompt,
-                entity_names=entity_names,
-                entities=entities,
-                size=size,
-                quality=quality
-            )
+async def _edit_story_tone(data: dict, story: Story, entities: EntityStore) -> None:
+    if story.settings is None:
+        story.settings = StorySettings()
+    story.settings.tone = data["tone"]
 
-        # result is `image_b64` (string) after you’ve called the image API
-        img_cfg = StoryImage(
-            index   = page_idx,
-            prompt  = prompt,
-            size    = size,
-            quality = quality,
-            image_b64 = image_b64,
-        )
 
-        # ensure we have a slot for this page
-        if len(story.images) <= page_idx:
-            story.images.extend([None] * (page_idx + 1 - len(story.images)))
-        story.images[page_idx] = img_cfg
+async def _edit_story_title(data: dict, story: Story, entities: EntityStore) -> None:
+    story.title = data["title"]
 
-        # nothing for extras now
-        return {}
 
-    elif tool == "generate_image":
-        prompt = data["prompt"]
-        entity_names = data.get("entity_names", [])
+async def _edit_story_genre(data: dict, story: Story, entities: EntityStore) -> None:
+    story.genre = data["genre"]
+
+
+async def _edit_story_keywords(data: dict, story: Story, entities: EntityStore) -> None:
+    story.keywords = data["keywords"]
+
+
+async def _no_tool(data: dict, story: Story, entities: EntityStore) -> None:
+    # deliberate no-op
+    pass
 
-        image_b64 = _generate_image(
-                prompt=prompt,
-                entity_names=entity_names,
-                entities=entities,
-            )
-        return {"image_b64": image_b64}
 
+async def _edit_image_prompt(data: dict, story: Story, entities: EntityStore) -> None:
+    # The only job here is to update the stored metadata of ONE page-image.
+    # Absolutely no story text or page list should change.
+
+    idx      = data["index"]          # zero-based page index
+    new_p    = data.get("prompt")    # may be None
+    new_size = data.get("size")      # may be None
+    new_q    = data.get("quality")   # may be None
+
+    # Ensure the images list is long enough to hold this page slot
+    _ensure_image_slot(story, idx)
+
+    # If the slot is empty, create a minimal StoryImage shell first
+    if story.images[idx] is None:
+        story.images[idx] = StoryImage(index=idx)
+
+    img_cfg = story.images[idx]
+
+    # Apply only the fields the user provided
+    if new_p is not None:
+        img_cfg.prompt = new_p
+    if new_size is not None:
+        img_cfg.size = new_size
+    if new_q is not None:
+        img_cfg.quality = new_q
+
+
+async def _generate_image_prompts_bulk(data: dict, story: Story, entities: EntityStore) -> None:
+    # One LLM call for every requested page instead of one tool call each
+    indexes = data.get("indexes")
+    if indexes is None:
+        indexes = range(len(story.pages))
     else:
+        try:
+            indexes = _PAGE_INDEXES.validate_python(indexes)
+        except ValidationError:
+            raise HTTPException(400, "indexes must be a list of integers.")
+    # Results go by list position; page.index may be stale mid-batch
+    positions = [i for i in indexes if 0 <= i < len(story.pages)]
+    if not positions:
+        raise HTTPException(400, "No pages to write image prompts for.")
+
+    pages = [story.pages[i] for i in positions]
+    prompts = await _generate_image_prompts(
+        pages, entities, data.get("instructions"), fresh=bool(data.get("regenerate"))
+    )
+
+    _ensure_image_slot(story, max(positions))
+    for i, new_p in zip(positions, prompts):
+        if not new_p:
+            continue
+        if story.images[i] is None:
+            story.images[i] = StoryImage(index=i)
+        story.images[i].prompt = new_p
+
+
+async def _edit_text(data: dict, story: Story, entities: EntityStore) -> None:
+    idx = data["index"]
+    if not 0 <= idx <= len(story.pages):
+        logger.warning("Page index %d out of bounds for edit_text. Page count: %d", idx, len(story.pages))
+        raise HTTPException(400, "Page index out of range.")
+    logger.info("✏️ Editing text on page %d", idx)
+    story.pages[idx].text = data["new_text"]
+
+
+async def _edit_all(data: dict, story: Story, entities: EntityStore) -> None:
+    try:
+        new_texts = _PAGE_TEXTS.validate_python(data["new_texts"])
+    except ValidationError:
+        raise HTTPException(400, "new_texts must be a list of strings.")
+    # Checked once above, so pages can be filled without per-page validation
+    _set_page_texts(story, new_texts)
+
+
+async def _insert_page(data: dict, story: Story, entities: EntityStore) -> None:
+    idx = data["index"]
+    text = data["text"]
+    if not 0 <= idx <= len(story.pages):
+        raise HTTPException(400, "Insert index out of range.")
+    story.pages.insert(idx, StoryText(index=idx, text=text))
+    _normalize_indexes(story, idx + 1)
+
+
+async def _delete_page(data: dict, story: Story, entities: EntityStore) -> None:
+    idx = data["index"]
+    if not 0 <= idx < len(story.pages):
+        raise HTTPException(400, "Delete index out of range.")
+    story.pages.pop(idx)
+    _normalize_indexes(story, idx)
+
+
+async def _move_page(data: dict, story: Story, entities: EntityStore) -> None:
+    frm, to = data["from_index"], data["to_index"]
+    if not (0 <= frm < len(story.pages)) or not (0 <= to < len(story.pages)):
+        raise HTTPException(400, "Move indexes out of range.")
+    page = story.pages.pop(frm)
+    story.pages.insert(to, page)
+    _normalize_indexes(story, min(frm, to), max(frm, to) + 1)
+
+
+# Entity tools
+async def _add_entity(data: dict, story: Story, entities: EntityStore) -> None:
+    name = data["name"]
+    if entities.has(name):
+        # Silently turn it into an update instead of bombing out
+        return await _update_entity(data, story, entities)
+    entities.add(StoryEntity(**data))
+
+
+async def _update_entity(data: dict, story: Story, entities: EntityStore) -> None:
+    ent = entities.get(data["name"])
+    if ent is None:
+        raise HTTPException(404, "Entity not found.")
+    if "new_name" in data and data["new_name"]:
+        if entities.has(data["new_name"]):
+            raise HTTPException(400, f"Entity '{data['new_name']}' already exists.")
+        entities.rename(ent, data["new_name"])
+    if "b64_json" in data:
+        ent.b64_json = data["b64_json"]
+        ent._raw = None       # drop the stale decoded copy
+    if "prompt" in data:
+        ent.prompt = data["prompt"]
+
+
+async def _delete_entity(data: dict, story: Story, entities: EntityStore) -> None:
+    ent = entities.get(data["name"])
+    if ent is None:
+        raise HTTPException(404, "Entity not found.")
+    entities.delete(ent)
+
+
+# Image tools
+async def _generate_image_for_index(data: dict, story: Story, entities: EntityStore) -> Dict:
+    page_idx      = data["index"]
+    prompt        = data["prompt"]
+    entity_names  = data.get("entity_names", [])
+    size    = data.get("size", "1024x1024")
+    quality = data.get("quality", "low")
+
+    raw, cached = await _generate_image(
+            prompt=prompt,
+            entity_names=entity_names,
+            entities=entities,
+            size=size,
+            quality=quality,
+            fresh=bool(data.get("regenerate")),
+        )
+
+    img_cfg = StoryImage(
+        index   = page_idx,
+        prompt  = prompt,
+        size    = size,
+        quality = quality,
+        image_url = image_url(await store_image(raw)),
+    )
+
+    # ensure we have a slot for this page
+    _ensure_image_slot(story, page_idx)
+    story.images[page_idx] = img_cfg
+
+    return {"image_cache": "HIT" if cached else "MISS"}
+
+
+async def _generate_image_tool(data: dict, story: Story, entities: EntityStore) -> Dict:
+    prompt = data["prompt"]
+    entity_names = data.get("entity_names", [])
+
+    raw, cached = await _generate_image(
+            prompt=prompt,
+            entity_names=entity_names,
+            entities=entities,
+            fresh=bool(data.get("regenerate")),
+        )
+    # Served as binary by GET /images/{uid} instead of base64 in the JSON
+    return {
+        "image_url": image_url(await store_image(raw)),
+        "image_cache": "HIT" if cached else "MISS",
+    }
+
+
+_TOOL_HANDLERS: Dict[str, ToolHandler] = {
+    "edit_story_prompt":           _edit_story_prompt,
+    "edit_target_page_count":      _edit_target_page_count,
+    "truncate_to_page_count":      _truncate_to_page_count,
+    "edit_story_tone":             _edit_story_tone,
+    "edit_story_title":            _edit_story_title,
+    "edit_story_genre":            _edit_story_genre,
+    "edit_story_keywords":         _edit_story_keywords,
+    "no_tool":                     _no_tool,
+    "edit_image_prompt":           _edit_image_prompt,
+    "generate_image_prompts_bulk": _generate_image_prompts_bulk,
+    "edit_text":                   _edit_text,
+    "edit_all":                    _edit_all,
+    "insert_page":                 _insert_page,
+    "delete_page":                 _delete_page,
+    "move_page":                   _move_page,
+    "add_entity":                  _add_entity,
+    "update_entity":               _update_entity,
+    "delete_entity":               _delete_entity,
+    "generate_image_for_index":    _generate_image_for_index,
+    "generate_image":              _generate_image_tool,
+}
+
+
+async def _apply_tool(
+    tool: str,
+    data: dict,
+    story: Story,
+    entities: EntityStore,
+) -> Dict:
+    """Mutate *story* and *entities* in‑place according to the tool call."""
+    handler = _TOOL_HANDLERS.get(tool)
+    if handler is None:
         # TODO: Respond with no tool
         raise HTTPException(400, f"Unknown tool {tool}")
 
-    return extras
+    if tool in _STORY_IMAGE_TOOLS:
+        story.touch_images()
+
+    return await handler(data, story, entities) or {}
@@ -0,0 +1,90 @@
+# app/features/story_chat/core/cache.py
+"""In-process LRU used to memoise OpenAI results by content hash.
+
+Keys are a blake2b digest of the request parts, so a repeated prompt (undo /
+redo, re-submitting the same edit) is answered without another round-trip.
+Identical requests that arrive while the first is still in flight wait for
+its result instead of issuing their own call.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+import orjson
+
+from ..config import logger
+
+T = TypeVar("T")
+
+
+def content_key(*parts: Any) -> bytes:
+    """Digest of JSON-serialisable *parts*; equal inputs give equal keys."""
+    return hashlib.blake2b(orjson.dumps(parts)).digest()
+
+
+class AsyncLRUCache(Generic[T]):
+    """LRU of at most *maxsize* results; entries older than *ttl* seconds
+    (if given) count as misses."""
+
+    def __init__(self, name: str, maxsize: int = 512, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[bytes, Tuple[float, T]]" = OrderedDict()   # key → (expires_at, value)
+        self._inflight: Dict[bytes, "asyncio.Future[T]"] = {}
+
+    def discard(self, key: bytes) -> None:
+        """Forget *key*, e.g. for a result that must not be replayed."""
+        self._data.pop(key, None)
+
+    async def get_or_compute(self, key: bytes, compute: Callable[[], Awaitable[T]], fresh: bool = False) -> T:
+        """Cached value for *key*, else `compute()`'s. With *fresh*, a stored
+        value is ignored and replaced (an in-flight call is still joined)."""
+        # Dict access never awaits, so no lock is needed on the event loop
+        entry = None if fresh else self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                logger.debug("%s cache hit (hits=%d misses=%d)", self.name, self.hits, self.misses)
+                return entry[1]
+            del self._data[key]                          # expired
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.hits += 1
+            logger.debug("%s joined in-flight call (hits=%d misses=%d)", self.name, self.hits, self.misses)
+            try:
+                return await asyncio.shield(pending)     # a cancelled waiter must not cancel the call
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise                                # we were cancelled ourselves
+                return await self.get_or_compute(key, compute, fresh)   # the caller we joined went away
+
+        self.misses += 1
+        logger.debug("%s cache miss (hits=%d misses=%d)", self.name, self.hits, self.misses)
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+        except BaseException as e:
+            # Waiters see the same error; nothing is cached, so the next call retries
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()                   # mark retrieved – waiters are optional
+            raise
+        finally:
+            del self._inflight[key]
+
+        future.set_result(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._data[key] = (expires_at, value)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return value
@@ -0,0 +1,82 @@
+# app/features/story_chat/core/entity_store.py
+"""Per-request entity collection with O(1) lookups by name.
+
+The list keeps the order the client sent (and the response returns); the dict
+answers `get` / `in` without scanning it. Deletes leave a hole that is
+compacted once, when the list is read back. Client-sent duplicates are
+kept; a name resolves to its first live entity.
+"""
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .schemas import StoryEntity
+
+
+class EntityStore:
+    def __init__(self, entities: Iterable[StoryEntity] = ()):
+        # A list is adopted as-is (not copied) and mutated in place
+        self._items: List[Optional[StoryEntity]] = entities if isinstance(entities, list) else list(entities)
+        self._by_name: Dict[str, StoryEntity] = {}
+        self._counts: Dict[str, int] = {}               # live entities per name
+        self._pos: Dict[int, int] = {}                  # id(entity) → slot in _items
+        self._holes = 0
+        for i, e in enumerate(self._items):
+            self._by_name.setdefault(e.name, e)     # first duplicate wins
+            self._counts[e.name] = self._counts.get(e.name, 0) + 1
+            self._pos[id(e)] = i
+
+    def __iter__(self) -> Iterator[StoryEntity]:
+        return (e for e in self._items if e is not None)
+
+    def __len__(self) -> int:
+        return len(self._items) - self._holes
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._by_name
+
+    @property
+    def items(self) -> List[StoryEntity]:
+        """The entities in order, e.g. for the response."""
+        if self._holes:
+            self._items[:] = [e for e in self._items if e is not None]
+            self._pos = {id(e): i for i, e in enumerate(self._items)}
+            self._holes = 0
+        return self._items
+
+    def get(self, name: str) -> Optional[StoryEntity]:
+        return self._by_name.get(name)
+
+    def has(self, name: str) -> bool:
+        return name in self._by_name
+
+    def add(self, entity: StoryEntity) -> None:
+        self._pos[id(entity)] = len(self._items)
+        self._items.append(entity)
+        self._by_name.setdefault(entity.name, entity)
+        self._counts[entity.name] = self._counts.get(entity.name, 0) + 1
+
+    def rename(self, entity: StoryEntity, new_name: str) -> None:
+        self._unlink(entity)
+        entity.name = new_name
+        self._by_name.setdefault(new_name, entity)
+        self._counts[new_name] = self._counts.get(new_name, 0) + 1
+
+    def delete(self, entity: StoryEntity) -> None:
+        """O(1): blank the slot instead of shifting the tail of the list."""
+        self._items[self._pos.pop(id(entity))] = None
+        self._holes += 1
+        self._unlink(entity)
+
+    def _unlink(self, entity: StoryEntity) -> None:
+        """Drop *entity* from the name index, falling back to the next live
+        entity of the same name; only duplicates pay for the scan."""
+        name = entity.name
+        left = self._counts.pop(name) - 1
+        if left:
+            self._counts[name] = left
+        if self._by_name.get(name) is not entity:
+            return
+        del self._by_name[name]
+        if left:
+            self._by_name[name] = next(
+                e for e in self._items if e is not None and e is not entity and e.name == name
+            )
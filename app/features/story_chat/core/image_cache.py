@@ -0,0 +1,122 @@
+# app/features/story_chat/core/image_cache.py
+"""Persistent exact-match cache for image generation results.
+
+Image calls are the slowest and most expensive part of a turn, and editing
+flows often repeat the same request. Results are keyed by everything that
+goes into the call – final prompt, size, quality and the reference images –
+and kept on disk so they survive restarts. The directory is bounded by
+`IMAGE_CACHE_MAX_BYTES`; least-recently-used files are evicted first.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from anyio import to_thread
+
+from ..config import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, logger
+
+# Bytes in IMAGE_CACHE_DIR as far as this process knows; stores add to it and
+# only going over budget triggers a directory scan
+_total_bytes: Optional[int] = None
+_lock = threading.Lock()
+
+
+def image_cache_key(prompt: str, size: str, quality: str, images: Iterable[bytes]) -> str:
+    digests = sorted(hashlib.sha256(raw).digest() for raw in images)
+    h = hashlib.sha256()
+    for part in (prompt.encode(), size.encode(), quality.encode(), *digests):
+        h.update(part)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _path(key: str) -> Path:
+    return Path(IMAGE_CACHE_DIR) / f"{key}.png"
+
+
+def _load(key: str) -> Optional[bytes]:
+    path = _path(key)
+    try:
+        raw = path.read_bytes()
+        os.utime(path)            # mark as recently used for LRU eviction
+    except FileNotFoundError:     # evicted, possibly by another worker mid-read
+        return None
+    return raw
+
+
+def _scan() -> Tuple[List[Tuple[float, int, Path]], int]:
+    """`(mtime, size, path)` of every cached file, and their total size."""
+    entries = []
+    total = 0
+    for path in Path(IMAGE_CACHE_DIR).glob("*.png"):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    return entries, total
+
+
+def init_image_cache() -> None:
+    """Seed the running size of the cache directory (one scan, at startup)."""
+    global _total_bytes
+    with _lock:
+        _total_bytes = _scan()[1]
+
+
+def _store(key: str, raw: bytes) -> None:
+    global _total_bytes
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    path = _path(key)
+    # Own temp file per write: concurrent stores of one key must not share it
+    with tempfile.NamedTemporaryFile(dir=IMAGE_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(raw)
+    with _lock:
+        # Overwriting a key only changes the total by the size difference
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        try:
+            os.replace(f.name, path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+        if _total_bytes is None:              # not seeded, e.g. outside the app lifespan
+            _total_bytes = _scan()[1]
+        else:
+            _total_bytes += len(raw) - old_size
+        if _total_bytes > IMAGE_CACHE_MAX_BYTES:
+            _evict()
+
+
+def _evict() -> None:
+    """Drop least-recently-used entries until the cache fits its budget.
+
+    Rescans the directory, which also corrects the running total for files
+    written by other worker processes.
+    """
+    global _total_bytes
+    entries, total = _scan()
+    if total > IMAGE_CACHE_MAX_BYTES:
+        entries.sort()
+        for _, size, path in entries:
+            path.unlink(missing_ok=True)
+            total -= size
+            if total <= IMAGE_CACHE_MAX_BYTES:
+                break
+        logger.info("Image cache evicted down to %d bytes", total)
+    _total_bytes = total
+
+
+# Disk access runs on worker threads so the event loop never waits on it
+async def load_cached_image(key: str) -> Optional[bytes]:
+    return await to_thread.run_sync(_load, key)
+
+
+async def store_cached_image(key: str, raw: bytes) -> None:
+    await to_thread.run_sync(_store, key, raw)
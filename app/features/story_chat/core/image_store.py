@@ -0,0 +1,78 @@
+# app/features/story_chat/core/image_store.py
+"""Short-lived store for generated images, served by `GET /images/{uid}`.
+
+Handing out a URL instead of embedding the PNG as base64 keeps multi-MB
+strings out of the JSON response. Images live on disk rather than in a
+per-process dict so that any worker can serve a URL issued by another one.
+"""
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple
+
+from anyio import to_thread
+
+from ..config import IMAGE_STORE_DIR, IMAGE_STORE_TTL, logger
+
+_UID_RE = re.compile(r"[0-9a-f]{32}")
+_SWEEP_INTERVAL = 60          # seconds between expiry sweeps
+_last_sweep = 0.0
+
+
+def _path(uid: str) -> Path:
+    return Path(IMAGE_STORE_DIR) / f"{uid}.png"
+
+
+def _sweep(now: float) -> None:
+    """Delete expired images; runs at most once per `_SWEEP_INTERVAL`."""
+    global _last_sweep
+    if now - _last_sweep < _SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    for path in Path(IMAGE_STORE_DIR).glob("*.png"):
+        try:
+            if now - path.stat().st_mtime > IMAGE_STORE_TTL:
+                path.unlink()
+        except FileNotFoundError:    # removed by another worker
+            pass
+
+
+def put_image(raw: bytes) -> str:
+    """Store *raw* PNG bytes and return the uid to fetch them by."""
+    now = time.time()
+    os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+    _sweep(now)
+
+    uid = uuid.uuid4().hex
+    path = _path(uid)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(raw)
+    os.replace(tmp, path)         # readers never see a half-written file
+    logger.debug("Stored image %s (%d bytes)", uid, len(raw))
+    return uid
+
+
+async def store_image(raw: bytes) -> str:
+    """`put_image` on a worker thread; the write and sweep never block the loop."""
+    return await to_thread.run_sync(put_image, raw)
+
+
+def find_image(uid: str) -> Optional[Tuple[Path, os.stat_result]]:
+    """Return the file of *uid* and its stat, or None if unknown or expired."""
+    if not _UID_RE.fullmatch(uid):
+        return None
+    path = _path(uid)
+    try:
+        st = path.stat()
+        if time.time() - st.st_mtime > IMAGE_STORE_TTL:
+            path.unlink(missing_ok=True)
+            return None
+        return path, st
+    except FileNotFoundError:
+        return None
+
+
+def image_url(uid: str) -> str:
+    return f"/images/{uid}"
@@ -0,0 +1,110 @@
+# app/features/story_chat/core/rate_limit.py
+"""Proactive request / token throttling for OpenAI calls.
+
+Waiting for a 429 and then backing off wastes the whole failed round-trip.
+Instead each call first takes capacity from a token bucket that refills at the
+configured per-minute rate, so bursts queue up locally just under the limit.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from openai import RateLimitError
+
+from ..config import logger, OPENAI_RPM, OPENAI_TPM, OPENAI_IMAGE_RPM
+
+
+class RateLimiter:
+    """Token bucket over requests and tokens per minute (0 = unlimited).
+
+    Waiters are served in arrival order. `block()` pauses everyone, e.g. for
+    the `Retry-After` of a 429 that got through anyway.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)   # capacity left in the bucket
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = self._blocked_until - now
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Wait until one request costing *tokens* fits under the limits."""
+        if self.tokens_per_minute:
+            tokens = min(tokens, int(self.tokens_per_minute))   # never wait forever
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    break
+                logger.debug("%s rate limit: waiting %.2fs", self.name, wait)
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+    def block(self, seconds: float) -> None:
+        """Hold back all callers for *seconds* (server-side rate limit hit)."""
+        until = time.monotonic() + seconds
+        if until > self._blocked_until:
+            logger.warning("%s rate limited by server; pausing %.1fs", self.name, seconds)
+            self._blocked_until = until
+
+
+@contextmanager
+def pause_on_429(limiter: RateLimiter) -> Iterator[None]:
+    """Block *limiter* for the `Retry-After` of a 429 raised inside, so
+    concurrent callers wait instead of hitting the limit too."""
+    try:
+        yield
+    except RateLimitError as e:
+        limiter.block(retry_after_seconds(e.response.headers))
+        raise
+
+
+def estimate_tokens(messages: Iterable[dict], max_tokens: Optional[int] = None) -> int:
+    """Rough prompt + completion size: ~4 characters per token."""
+    prompt_chars = sum(len(m.get("content") or "") for m in messages)
+    return prompt_chars // 4 + (max_tokens or 0)
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    """Parse a numeric `Retry-After` header, falling back to *default*."""
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+# Limits are per process – with N workers, configure 1/N of the account limit.
+chat_limiter = RateLimiter("chat", OPENAI_RPM, OPENAI_TPM)
+image_limiter = RateLimiter("images", OPENAI_IMAGE_RPM)
@@ -1,28 +1,43 @@
 # app/features/story_chat/core/reply_agent.py
-from openai import OpenAI
 from .schemas import Story, StoryEntity, StoryText
-from ..config import client, MAX_HISTORY
-from app.features.story_chat.core.utils import (_parse_json_or_lines, _clean_json_fence, _normalize_indexes, _find_entity, _summarise_images)
-import json
+from .entity_store import EntityStore
+from ..config import client
+from app.features.story_chat.core.utils import (_parse_json_or_lines, _clean_json_fence, _normalize_indexes, _story_images_summary)
+from .rate_limit import chat_limiter, estimate_tokens, pause_on_429
+import orjson
 
-def reply_agent(
+
+def _compact_arg(value):
+    """Shorten one tool argument for the reply prompt.
+
+    Page texts and image prompts already appear in the story context below,
+    so long strings are cut and lists are reduced to a count.
+    """
+    if isinstance(value, str) and len(value) > 80:
+        return value[:80] + "…"
+    if isinstance(value, list) and len(value) > 3:
+        return f"[{len(value)} items]"
+    return value
+
+
+async def reply_agent(
     user_msg: str,
     story_before: Story,
     story_after: Story,
-    entities: list[StoryEntity],
+    entities: EntityStore,
     history: list[dict],
     tool_calls: list[tuple[str, dict]] | None = None,
 ) -> str:
     """Generate the assistant’s human-language answer after tools ran."""
-    history = history[-MAX_HISTORY:]
-    images_summary = _summarise_images(story_after.images)
+    images_summary = _story_images_summary(story_after)
 
     recent_tool_note = ""
     if tool_calls:
         lines = []
         for name, args in tool_calls:
             if args:
-                lines.append(f"• {name} → {json.dumps(args, ensure_ascii=False)}")
+                compact = {k: _compact_arg(v) for k, v in args.items()}
+                lines.append(f"• {name} → {orjson.dumps(compact).decode()}")
             else:
                 lines.append(f"• {name}")
         recent_tool_note = "### TOOLS JUST EXECUTED\n" + "\n".join(lines) + "\n\n"
@@ -55,14 +70,16 @@ def reply_agent(
                 "### STORY TEXT AFTER CHANGES\n"
                 f"{summarise_story(story_after.pages)}\n\n"
             )
-        }] + history
+        }, *history]
     )
 
-    resp = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=500,
-        temperature=0.7,
-    )
+    await chat_limiter.acquire(estimate_tokens(messages, 500))
+    with pause_on_429(chat_limiter):
+        resp = await client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=500,
+            temperature=0.7,
+        )
     return resp.choices[0].message.content.strip()
 
@@ -1,7 +1,12 @@
-from pydantic import BaseModel, Field
+import binascii
+import hashlib
+from collections import OrderedDict
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
 from typing import Dict, List, Optional, Tuple
 from enum import Enum
 
+from ..config import MAX_HISTORY, MAX_ENTITY_IMAGE_CHARS
+
 # ────────────────────────────
 # ░░ Data models ░░
 # ────────────────────────────
@@ -27,6 +32,7 @@ class Mode(str, Enum):
 
 
     EDIT_IMAGE_PROMPT = "edit_image_prompt"
+    GENERATE_IMAGE_PROMPTS_BULK = "generate_image_prompts_bulk"
     GENERATE_IMAGE_FOR_INDEX = "generate_image_for_index"
     GENERATE_IMAGE ="generate_image"
 
@@ -45,14 +51,48 @@ class StoryImage(BaseModel):
     prompt: Optional[str] = None        # prompt actually used for this image
     size:   Optional[str] = None        # 512×512 … 1024×1792
     quality: Optional[str] = None       # low / medium / high
-    image_b64: Optional[str] = None      # base64 of the generated PNG
+    image_b64: Optional[str] = None      # deprecated – see `image_url`
+    image_url: Optional[str] = None      # `/images/{uid}` of the generated PNG (expires)
+
+
+# Entity images come back on every request of a session; keep recent decodes.
+# Keyed by a digest of the base64 text so the cache never holds those strings,
+# and bounded by decoded size since a single image can be several MB.
+_DECODED_IMAGES: "OrderedDict[bytes, bytes]" = OrderedDict()
+_DECODED_IMAGES_MAX_BYTES = 64 * 1024**2
+_decoded_bytes = 0
+
+
+def _decoded_image(b64: str) -> bytes:
+    global _decoded_bytes
+    key = hashlib.blake2b(b64.encode(), digest_size=16).digest()
+    raw = _DECODED_IMAGES.get(key)
+    if raw is not None:
+        _DECODED_IMAGES.move_to_end(key)
+        return raw
+    raw = binascii.a2b_base64(b64)
+    if len(raw) <= _DECODED_IMAGES_MAX_BYTES:
+        _DECODED_IMAGES[key] = raw
+        _decoded_bytes += len(raw)
+        while _decoded_bytes > _DECODED_IMAGES_MAX_BYTES:
+            _decoded_bytes -= len(_DECODED_IMAGES.popitem(last=False)[1])
+    return raw
 
 
 class StoryEntity(BaseModel):
     name: str = Field(default="")  # identifier (unique)
-    b64_json: Optional[str] = None  # input image from the user
+    b64_json: Optional[str] = Field(default=None, max_length=MAX_ENTITY_IMAGE_CHARS)  # input image from the user
     prompt: Optional[str] = None    # input description/prompt from the user
 
+    _raw: Optional[bytes] = PrivateAttr(default=None)  # decoded `b64_json`
+
+    @property
+    def raw_image(self) -> Optional[bytes]:
+        """Decoded image bytes; `b64_json` is decoded at most once per instance."""
+        if self._raw is None and self.b64_json:
+            self._raw = _decoded_image(self.b64_json)
+        return self._raw
+
 
 class StoryText(BaseModel):
     index: int
@@ -62,13 +102,20 @@ class StoryText(BaseModel):
 class Story(BaseModel):
     prompt: str = Field(default="")
     pages: List[StoryText] = Field(default_factory=list)
-    images: List[StoryImage] = Field(default_factory=list)
+    images: List[Optional[StoryImage]] = Field(default_factory=list)   # None = page without image yet
     settings: Optional[StorySettings] = None
 
     title: str = Field(default="")                 # Book title
     genre: Optional[str] = None                    # e.g. "Fantasy"
     keywords: Optional[List[str]] = None           # ["dragons", "friendship"]
 
+    _images_version: int = PrivateAttr(default=0)
+    _images_summary: Optional[Tuple[int, str]] = PrivateAttr(default=None)   # (version, text)
+
+    def touch_images(self) -> None:
+        """Mark `images` as changed so cached summaries are rebuilt."""
+        self._images_version += 1
+
 class ChatRequest(BaseModel):
     """Frontend payload.
 
@@ -81,13 +128,24 @@ class ChatRequest(BaseModel):
     entities: Optional[List[StoryEntity]] = None
     history: Optional[List[dict]] = None
 
+    @field_validator("history", mode="before")
+    @classmethod
+    def _recent_history(cls, v):
+        # Only the last MAX_HISTORY turns are used; don't validate the rest.
+        # Twice as many raw messages, since every turn may carry a tool log entry.
+        if isinstance(v, list) and len(v) > 2 * MAX_HISTORY:
+            return v[-2 * MAX_HISTORY:]
+        return v
+
+
 
 class ChatResponse(BaseModel):
     modes: List[Mode]
     assistant_output: Optional[str] = None
     story: Optional[Story] = None
     entities: Optional[List[StoryEntity]] = None
-    image_b64: Optional[str] = None
+    image_b64: Optional[str] = None      # deprecated – see `image_url`
+    image_url: Optional[str] = None      # `/images/{uid}` of a `generate_image` result
     history: Optional[List[dict]] = None
     settings: Optional[StorySettings] = None
 
@@ -0,0 +1,74 @@
+# app/features/story_chat/core/semantic_cache.py
+"""Near-duplicate lookup for generated pages, by prompt embedding.
+
+Users often re-send a prompt with slightly different wording. The exact
+content-hash caches miss those; here the prompt is embedded and compared by
+cosine similarity with earlier prompts that were written under the same
+context (entities, tone, page count). Vectors are unit length, so the
+similarity is a plain dot product – no index library needed at this size.
+"""
+import math
+import operator
+import time
+from collections import deque
+from typing import Deque, Generic, List, Optional, Tuple, TypeVar
+
+from openai import OpenAIError
+
+from ..config import logger, client, OPENAI_CACHE_TTL
+from .cache import AsyncLRUCache, content_key
+
+T = TypeVar("T")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 256      # shortened vectors keep the linear scan cheap
+
+_EMBEDDINGS: AsyncLRUCache[List[float]] = AsyncLRUCache("embeddings", maxsize=1024, ttl=OPENAI_CACHE_TTL)
+
+
+async def embed(text: str) -> Optional[List[float]]:
+    """Unit-length embedding of *text*, memoised; None if the call fails."""
+    async def compute() -> List[float]:
+        resp = await client.embeddings.create(
+            model=EMBEDDING_MODEL, input=text, dimensions=EMBEDDING_DIMENSIONS
+        )
+        vec = resp.data[0].embedding
+        norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+        return [x / norm for x in vec]
+
+    try:
+        return await _EMBEDDINGS.get_or_compute(content_key(EMBEDDING_MODEL, text), compute)
+    except OpenAIError as e:
+        logger.warning("Embedding failed, skipping semantic cache: %s", e)
+        return None
+
+
+class SemanticCache(Generic[T]):
+    """The *maxsize* most recent `(context, vector) → value` entries.
+
+    `lookup` returns the value of the most similar entry of the same context
+    if its similarity is at least *threshold*.
+    """
+
+    def __init__(self, name: str, threshold: float, maxsize: int = 256, ttl: Optional[float] = None):
+        self.name = name
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries: Deque[Tuple[bytes, float, List[float], T]] = deque(maxlen=maxsize)
+
+    def lookup(self, context: bytes, vector: List[float]) -> Optional[T]:
+        now = time.monotonic()
+        best, best_sim = None, self.threshold
+        for ctx, expires_at, vec, value in self._entries:
+            if ctx != context or expires_at <= now:
+                continue
+            sim = sum(map(operator.mul, vec, vector))
+            if sim >= best_sim:
+                best, best_sim = value, sim
+        if best is not None:
+            logger.info("%s semantic cache hit (similarity %.3f)", self.name, best_sim)
+        return best
+
+    def add(self, context: bytes, vector: List[float], value: T) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._entries.append((context, expires_at, vector, value))
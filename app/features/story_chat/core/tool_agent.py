@@ -14,32 +14,145 @@ inspect them later or drive more advanced logic.
   `content` keys preserved, ready to send to the OpenAI Chat API.
 """
 
-import json
+import orjson
+from openai import OpenAIError
 from typing import Dict, List, Optional, Tuple
 
 from .schemas import Story, StoryEntity
-from .tools import TOOLS
+from .tools import TOOLS, TOOLS_TOKENS, TOOLS_WITHOUT_PAGES, TOOLS_WITHOUT_PAGES_TOKENS
+from .entity_store import EntityStore
 from app.features.story_chat.core.utils import (
     _parse_json_or_lines,
     _clean_json_fence,
     _normalize_indexes,
-    _find_entity,
-    _summarise_images,
+    _story_images_summary,
+    _summarise_pages,
 )
-from ..config import client, MAX_HISTORY
+from ..config import client, MAX_HISTORY, OPENAI_CACHE_TTL
 from .utils import logger
+from .cache import AsyncLRUCache, content_key
+from .rate_limit import chat_limiter, estimate_tokens, pause_on_429
 
 
 
+# ---------------------------------------------------------------------------
+# System prompt
+# ---------------------------------------------------------------------------
+
+# Everything that does not depend on the request. Sent as its own system
+# message, never formatted, so it is a byte-identical prefix on every call;
+# the live STORY CONTEXT goes in a separate message (see `_tool_agent`).
+_STATIC_SYSTEM_PROMPT = (
+    "You are StoryGPT‑DECIDER.  **Always** reply with *at least one* OpenAI tool‑call.\n"
+    "If the user is only chatting, emit the `no_tool` function.\n"
+    "Never produce natural‑language output yourself.\n\n"
+    "Use the language of the user.\n\n"
+
+    "### BOOTSTRAP RULE\n"
+    "• If you choose `edit_story_prompt` and the story has no pages, entities, or images:\n"
+    "– You MUST also include:\n"
+    "    • One `edit_story_title` call to set an initial title.\n"
+    "    • One `edit_all` call to create full page content for the story. \n"
+    "    • One `update_entity` call for **each entity** that should appear in the story.\n"
+    "    • One `generate_image_prompts_bulk` call, after `edit_all`, to write every page's image prompt.\n"
+
+    "### DECISION FLOW\n"
+    "• You may return MULTIPLE tool calls in a single response.\n"
+    "• Consider chat history, but prioritise the most recent message.\n"
+    "• If the number of pages is greater than `target_page_count`, and the user is asking to reduce or regenerate content, add a `truncate_to_page_count` call to remove the extra pages and images.\n\n"
+
+    "### IMAGE RULES\n"
+    "• Only generate images when clearly asked (e.g. 'generate image', 'create illustrations').\n"
+    "• If user asks for 'image prompts' or visual descriptions, use `edit_image_prompt`, NOT `generate_image`.\n"
+    "• When more than one page needs an image prompt, call `generate_image_prompts_bulk` ONCE instead of several `edit_image_prompt` calls.\n"
+    "• Prefer `generate_image_for_index` over `generate_image` when the target is a specific page.\n\n"
+
+    "### TEXT FORMAT RULES (applies to `edit_all`, `edit_text`, `insert_page`, etc.)\n"
+    "• Use a descriptive narrative style (not poetry, not dialogue-only).\n"
+    "• Keep each page to 1–2 short sentences or one concise paragraph. Unless stated otherwise\n"
+    "• Text should flow logically and naturally from previous pages (if any).\n"
+    "• Integrate the story prompt and listed entities where appropriate.\n"
+    "• Avoid formatting artifacts:\n"
+    "  – Do NOT include labels like \"Page 1:\"\n"
+    "  – Do NOT use markdown, quotes, or code blocks\n\n"
+
+    "### TOOLS\n"
+    "• edit_story_prompt – Replace the overall story prompt. Set `regenerate_pages` to rewrite every page and its image prompt from it, and put the rewritten pages in `new_pages` yourself.\n\n"
+    "• edit_story_title – Update the story’s title.\n"
+    "• edit_story_genre – Update the genre (e.g. 'Fantasy').\n"
+    "• edit_story_keywords – Replace the list of keywords (array of strings).\n\n"
+    "• edit_target_page_count – Set how many pages the story should have (integer)\n"
+    "• truncate_to_page_count – Trim the story’s pages and images to match the current `target_page_count`.\n"
+    "• edit_story_tone – Change the overall tone (string, e.g. 'spooky')\n\n"
+    "• edit_text – Replace a specific page.\n"
+    "• edit_all – Replace all pages.\n"
+    "• insert_page – Add a new page.\n"
+    "• delete_page – Remove a page.\n"
+    "• move_page – Reorder pages.\n\n"
+    "• add_entity – Create a new character or entity.\n"
+    "• update_entity – Change name, image, or prompt. (Use empty string to clear prompt.)\n"
+    "• delete_entity – Remove an entity.\n\n"
+    "• edit_image_prompt – Modify image metadata (prompt). Does NOT regenerate.\n"
+    "• generate_image_prompts_bulk – Write the image prompts of several (or all) pages at once. Does NOT regenerate.\n"
+    "• generate_image_for_index – Generate image for a specific story page.\n"
+    "• generate_image – General‑purpose image (e.g. character portrait, cover art).\n"
+    "  For the image and bulk-prompt tools, set `regenerate` when the user asks to redo a result they already have.\n\n"
+
+    "### ENTITY IMAGE LOGIC\n"
+    "• Entities may have:\n"
+    "  – Just a prompt → fully describes the entity.\n"
+    "  – An image + prompt → prompt describes modifications or extra details.\n\n"
+
+    "### EXAMPLE\n"
+    "User: Create two characters and write a story about them.\n"
+    "Tool calls:\n"
+    "1. add_entity → name: Valandor, prompt: A brave warrior with golden armour.\n"
+    "2. add_entity → name: Lyra, prompt: A healer in silver robes.\n"
+    "3. edit_story_prompt → new_prompt: A tale of Valandor and Lyra on a quest to save their world.\n"
+    "\n"
+    "User: Rewrite the story to be 3 pages instead of 5.\n"
+    "Tool calls:\n"
+    "1. edit_target_page_count → target_page_count: 3\n"
+    "2. edit_all → new_texts: [ ...3 new pages... ]\n"
+    "3. truncate_to_page_count\n\n"
+)
+
+
+# Identical conversation + story state → identical decision (the decider runs
+# at temperature 0). Raw argument strings are cached so every hit parses into
+# fresh dicts.
+_DECISION_CACHE: AsyncLRUCache[List[Tuple[str, str]]] = AsyncLRUCache(
+    "tool_agent", maxsize=256, ttl=OPENAI_CACHE_TTL
+)
+
+
+async def _decide(messages: List[dict], has_pages: bool = True) -> List[Tuple[str, str]]:
+    tools, tools_tokens = (TOOLS, TOOLS_TOKENS) if has_pages else (TOOLS_WITHOUT_PAGES, TOOLS_WITHOUT_PAGES_TOKENS)
+    # The tool definitions count against TPM like the prompt does
+    await chat_limiter.acquire(estimate_tokens(messages) + tools_tokens)
+    with pause_on_429(chat_limiter):
+        resp = await client.chat.completions.create(
+            model="gpt-4.1",
+            messages=messages,
+            tool_choice="required",
+            temperature=0,
+            # Passed as-is: as a typed `tools=` argument the SDK re-walks the
+            # whole nested schema on every call (~1.5 ms) to produce the same dict
+            extra_body={"tools": tools},
+        )
+    msg = resp.choices[0].message
+    return [(call.function.name, call.function.arguments) for call in msg.tool_calls or []]
+
+
 # ---------------------------------------------------------------------------
 # Main entry point
 # ---------------------------------------------------------------------------
 
-def _tool_agent(
+async def _tool_agent(
     story: Story,
-    entities: List[StoryEntity],
+    entities: EntityStore,
     history: List[dict],
-) -> Tuple[List[Tuple[str, dict]], Optional[str]]:
+) -> List[Tuple[str, dict]]:
     """Decide which tool(s) to invoke **and** persist a log of those tools
     inside *history* (for downstream analytics / workflows).
 
@@ -52,140 +165,62 @@ def _tool_agent(
     API never sees unsupported roles.
     """
     # ── 2. Build the system prompt with live story context ───────────────
-    images_summary = _summarise_images(story.images)
+    images_summary = _story_images_summary(story)
     target_page_count = (
         story.settings.target_page_count
         if story.settings and story.settings.target_page_count
         else 5)
-    
-    target_page_count_instruction = f"- target_page_count: {target_page_count}"
 
     tone_instruction = (
-        f"- tone: {story.settings.tone} \\n"
+        f"   - tone: {story.settings.tone}\n"
         if story.settings and story.settings.tone
         else ""
     )
 
-
-    SYSTEM_PROMPT = (
-        "You are StoryGPT‑DECIDER.  **Always** reply with *at least one* OpenAI tool‑call.\n"
-        "If the user is only chatting, emit the `no_tool` function.\n"
-        "Never produce natural‑language output yourself.\n\n"
-        "Use the language of the user."
-
-        "### BOOTSTRAP RULE\n"
-        "• If you choose `edit_story_prompt` and the story has no pages, entities, or images:\n"
-        "– You MUST also include:\n"
-        "    • One `edit_story_title` call to set an initial title.\n"
-        "    • One `edit_all` call to create full page content for the story. \n"
-        "    • One `update_entity` call for **each entity** that should appear in the story.\n"
-        "    • One `edit_image_prompt` call for **each story page**, with the appropriate `index`.\n"
-
-        "### DECISION FLOW\n"
-        "• If the user intends to use tools, respond ONLY with tool calls (OpenAI tool format). No natural language.\n"
-        "• You may return MULTIPLE tool calls in a single response.\n"
-        "• Consider chat history, but prioritise the most recent message.\n"
-        "• If the number of pages is greater than `target_page_count`, and the user is asking to reduce or regenerate content, add a `truncate_to_page_count` call to remove the extra pages and images.\n\n"
-
-        "### IMAGE RULES\n"
-        "• Only generate images when clearly asked (e.g. 'generate image', 'create illustrations').\n"
-        "• If user asks for 'image prompts' or visual descriptions, use `edit_image_prompt`, NOT `generate_image`.\n"
-        "• Prefer `generate_image_for_index` over `generate_image` when the target is a specific page.\n\n"
-
+    state_prompt = (
         "### STORY CONTEXT\n"
         f"• Prompt: {story.prompt}\n"
         f"• Title: {story.title or '–'}\n"
         f"• Genre: {story.genre or '–'}\n"
         f"• Keywords: {', '.join(story.keywords) if story.keywords else '–'}\n"
         "• Story Settings:\n"
-        f"   {tone_instruction}"
-        f"   {target_page_count_instruction}"
-        f"• Story: {story.pages}\n"
+        f"{tone_instruction}"
+        f"   - target_page_count: {target_page_count}\n"
+        f"• Pages ({len(story.pages)}):\n{_summarise_pages(story.pages)}\n"
         f"• Entities ({len(entities)}): {', '.join(e.name for e in entities) or '–'}\n"
-        f"• Image Prompts ({sum(1 for i in story.images if i)}):\n{images_summary}\n\n"
-
-
-
-        "### TEXT FORMAT RULES (applies to `edit_all`, `edit_text`, `insert_page`, etc.)\\n"
-        "• Use a descriptive narrative style (not poetry, not dialogue-only).\\n"
-        "• Keep each page to 1–2 short sentences or one concise paragraph. Unless stated otherwise\\n"
-        "• Text should flow logically and naturally from previous pages (if any).\\n"
-        "• Integrate the story prompt and listed entities where appropriate.\\n"
-        "• Avoid formatting artifacts:\\n"
-        "  – Do NOT include labels like \\\"Page 1:\\\"\\n"
-        "  – Do NOT use markdown, quotes, or code blocks\\n"
-
-        "### TOOLS\n"
-        "• edit_story_prompt – Replace the overall story prompt.\n\n"
-        "• edit_story_title – Update the story’s title.\n"
-        "• edit_story_genre – Update the genre (e.g. 'Fantasy').\n"
-        "• edit_story_keywords – Replace the list of keywords (array of strings).\n\n"
-        "• edit_target_page_count – Set how many pages the story should have (integer)\n"
-        "• truncate_to_page_count – Trim the story’s pages and images to match the current `target_page_count`.\n"
-        "• edit_story_tone – Change the overall tone (string, e.g. 'spooky')\n\n"
-        "• edit_text – Replace a specific page.\n"
-        "• edit_all – Replace all pages.\n"
-        "• insert_page – Add a new page.\n"
-        "• delete_page – Remove a page.\n"
-        "• move_page – Reorder pages.\n\n"
-        "• add_entity – Create a new character or entity.\n"
-        "• update_entity – Change name, image, or prompt. (Use empty string to clear prompt.)\n"
-        "• delete_entity – Remove an entity.\n\n"
-        "• edit_image_prompt – Modify image metadata (prompt). Does NOT regenerate.\n"
-        "• generate_image_for_index – Generate image for a specific story page.\n"
-        "• generate_image – General‑purpose image (e.g. character portrait, cover art).\n\n"
-
-        "### ENTITY IMAGE LOGIC\n"
-        "• Entities may have:\n"
-        "  – Just a prompt → fully describes the entity.\n"
-        "  – An image + prompt → prompt describes modifications or extra details.\n\n"
-
-        "### EXAMPLE\n"
-        "User: Create two characters and write a story about them.\n"
-        "Tool calls:\n"
-        "1. add_entity → name: Valandor, prompt: A brave warrior with golden armour.\n"
-        "2. add_entity → name: Lyra, prompt: A healer in silver robes.\n"
-        "3. edit_story_prompt → new_prompt: A tale of Valandor and Lyra on a quest to save their world.\n"
-        "\n"
-        "User: Rewrite the story to be 3 pages instead of 5.\n"
-        "Tool calls:\n"
-        "1. edit_target_page_count → target_page_count: 3\n"
-        "2. edit_all → new_texts: [ ...3 new pages... ]\n"
-        "3. truncate_to_page_count\n"
-
+        f"• Image Prompts ({sum(1 for i in story.images if i)}):\n{images_summary}\n"
     )
 
     # ── 3. Prepare messages for the model ────────────────────────────────
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+    # Rules, then the (append-only) conversation, then the state that changes
+    # every turn – OpenAI's prompt cache can reuse everything before the tail.
+    messages = [
+        {"role": "system", "content": _STATIC_SYSTEM_PROMPT},
+        *history,
+        {"role": "system", "content": state_prompt},
+    ]
 
     # ── 4. Call the model and parse tool calls ───────────────────────────
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="required",
+        # The state message carries the page count, so the key also
+        # determines which tool subset was offered
+        decided = await _DECISION_CACHE.get_or_compute(
+            content_key("gpt-4.1", 0, messages),
+            lambda: _decide(messages, has_pages=bool(story.pages)),
         )
 
-        msg = resp.choices[0].message
         tool_calls: List[Tuple[str, dict]] = []
-        called_tool_names: List[str] = []
-
-        if msg.tool_calls:
-            for call in msg.tool_calls:
-                try:
-                    args = json.loads(call.function.arguments or "{}")
-                except json.JSONDecodeError:
-                    args = {}
-                tool_calls.append((call.function.name, args))
-                called_tool_names.append(call.function.name)
-
-        else:
-            tool_calls = [("no_tool", {})]
-            called_tool_names.append("no_tool")
+        for name, raw_args in decided:
+            try:
+                args = orjson.loads(raw_args or "{}")
+            except orjson.JSONDecodeError:
+                args = {}
+            tool_calls.append((name, args))
 
-        return tool_calls
+        return tool_calls or [("no_tool", {})]
 
+    except OpenAIError:
+        raise                             # surfaced as 502 by the controller
     except Exception as e:
         logger.error(f"Error deciding which tool: {e}", exc_info=True)
-        return [], "I couldn't handle this request - can you please specify the request?"
+        return [("no_tool", {})]
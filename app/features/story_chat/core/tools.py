@@ -1,5 +1,7 @@
 from typing import Dict, List, Optional, Tuple
 
+import orjson
+
 # ────────────────────────────
 # ░░ OpenAI tool definitions ░░
 # ────────────────────────────
@@ -127,6 +129,35 @@ TOOLS: List[Dict] = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "generate_image_prompts_bulk",
+            "description": (
+                "Write the image prompt for several pages in one go. Use instead of "
+                "multiple `edit_image_prompt` calls. Does NOT call the image model."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "indexes": {
+                        "type": "array",
+                        "items": { "type": "integer" },
+                        "description": "Page indexes to write prompts for. Omit for all pages."
+                    },
+                    "instructions": {
+                        "type": "string",
+                        "description": "Optional style or content guidance from the user."
+                    },
+                    "regenerate": {
+                        "type": "boolean",
+                        "description": "The user wants a new version of an earlier result; don't reuse it."
+                    }
+                },
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -141,6 +172,10 @@ TOOLS: List[Dict] = [
                     "type": "array",
                     "items": { "type": "string" },
                     "description": "Names of entities to reference."
+                    },
+                "regenerate": {
+                    "type": "boolean",
+                    "description": "The user wants a new version of an earlier result; don't reuse it."
                     }
             },
             "required": ["index", "prompt"]
@@ -160,6 +195,10 @@ TOOLS: List[Dict] = [
                         "type": "array",
                         "items": {"type": "string"},
                         "description": "Names of entities to include in the image generation."
+                    },
+                    "regenerate": {
+                        "type": "boolean",
+                        "description": "The user wants a new version of an earlier result; don't reuse it."
                     }
                 },
                 "required": ["prompt"]
@@ -251,7 +290,26 @@ TOOLS: List[Dict] = [
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "new_prompt": {"type": "string", "description": "New prompt."}
+                    "new_prompt": {"type": "string", "description": "New prompt."},
+                    "regenerate_pages": {
+                        "type": "boolean",
+                        "description": "Rewrite every page, and its image prompt, from the new prompt.",
+                    },
+                    "new_pages": {
+                        "type": "array",
+                        "description": (
+                            "With regenerate_pages: the rewritten pages themselves, in order. "
+                            "Fill this in whenever you can, so no second writing call is needed."
+                        ),
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "text": {"type": "string", "description": "Page text."},
+                                "image_prompt": {"type": "string", "description": "Illustration prompt for the page."},
+                            },
+                            "required": ["text"],
+                        },
+                    },
                 },
                 "required": ["new_prompt"],
             },
@@ -307,4 +365,15 @@ TOOLS: List[Dict] = [
             },
         },
     }
-]
\ No newline at end of file
+]
+
+# Encoded once at import; the definitions never change at runtime
+TOOLS_JSON: bytes = orjson.dumps(TOOLS)
+TOOLS_TOKENS = len(TOOLS_JSON) // 4        # same ~4 chars/token as estimate_tokens
+
+# Tools that only act on existing pages. They are left out while the story has
+# none, which saves their schema tokens on the first turns. The bootstrap
+# tools (edit_all, generate_image_prompts_bulk, ...) stay available.
+PAGE_TOOLS = frozenset({"edit_text", "delete_page", "move_page", "truncate_to_page_count"})
+TOOLS_WITHOUT_PAGES: List[Dict] = [t for t in TOOLS if t["function"]["name"] not in PAGE_TOOLS]
+TOOLS_WITHOUT_PAGES_TOKENS = len(orjson.dumps(TOOLS_WITHOUT_PAGES)) // 4
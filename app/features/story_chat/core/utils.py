@@ -1,8 +1,10 @@
 
-import json
 import logging
 import re
-from typing import Dict, List, Optional, Tuple
+from contextvars import ContextVar
+from functools import lru_cache
+import orjson
+from typing import AsyncIterator, Callable, Deque, Dict, Iterable, List, Optional, Tuple
 from .schemas import (
     Story,
     StoryText,
@@ -12,7 +14,10 @@ from .schemas import (
     Mode,
     StoryImage,
 )
-from ..config import (logger, client, MAX_HISTORY)
+from ..config import (logger, client, MAX_HISTORY, OPENAI_CACHE_TTL, PAGES_SEMANTIC_THRESHOLD)
+from .cache import AsyncLRUCache, content_key
+from .rate_limit import chat_limiter, estimate_tokens, pause_on_429
+from .semantic_cache import SemanticCache, embed
 
 # ---------------------------------------------------------------------------
 # Helper utilities
@@ -25,13 +30,87 @@ def history_for_api(raw_history: List[Dict[str, str]]) -> List[Dict[str, str]]:
     All other messages are returned as-is.
     """
     return [msg for msg in raw_history if msg.get("role") != "tool"]
-def _generate_story_pages(story, entities: Optional[List[StoryEntity]] = None) -> List[str]:
-    """Call OpenAI to expand the prompt into *n* 1‑2 sentence pages."""
+
+
+_SUMMARY_PREFIX = "Summary of earlier turns:\n"
+_SUMMARY_MAX_LINES = 10
+
+
+def _approx_tokens(msg: Dict[str, str]) -> int:
+    return len(msg.get("content") or "") // 4
+
+
+def split_summary(messages: List[dict]) -> Tuple[Optional[dict], List[dict]]:
+    """Separate a leading summary left by `compact_history` from the turns."""
+    if messages:
+        first = messages[0]
+        if first.get("role") == "system" and (first.get("content") or "").startswith(_SUMMARY_PREFIX):
+            return first, messages[1:]
+    return None, messages
+
+
+def compact_history(history: Deque[dict], budget: int, summary: Optional[dict] = None) -> Optional[dict]:
+    """Fold the oldest turns of *history* (in place) into *summary* until
+    both together fit *budget* (approximate tokens); returns the summary.
+
+    The summary is a deterministic list of the user's earlier requests – no
+    extra model call. It is kept out of the bounded *history* so appends can
+    never push it out; callers put it first, in the cached prefix.
+    The latest message is always kept.
+    """
+    total = sum(_approx_tokens(m) for m in history)
+    if summary is not None:
+        total += _approx_tokens(summary)
+    if total <= budget:
+        return summary
+
+    lines: List[str] = []
+    if summary is not None:
+        total -= _approx_tokens(summary)
+        lines = summary["content"][len(_SUMMARY_PREFIX):].splitlines()
+
+    while total > budget and len(history) > 1:
+        msg = history.popleft()
+        total -= _approx_tokens(msg)
+        if msg.get("role") == "user":
+            content = " ".join((msg.get("content") or "").split())
+            lines.append("- user asked: " + (content[:100] + "…" if len(content) > 100 else content))
+
+    if not lines:
+        return None
+    return {
+        "role": "system",
+        "content": _SUMMARY_PREFIX + "\n".join(lines[-_SUMMARY_MAX_LINES:]),
+    }
+
+
+# Same prompt, entities and settings → same pages (see `_generate_story_pages`)
+_PAGES_CACHE: AsyncLRUCache[Tuple[List[str], List[str]]] = AsyncLRUCache("story_pages", maxsize=512, ttl=OPENAI_CACHE_TTL)
+# Set by `/chat/stream` to receive `(index, text, image_prompt)` of each page
+# as soon as it is written
+_page_listener: ContextVar[Optional[Callable[[int, str, str], None]]] = ContextVar("page_listener", default=None)
+
+# Reworded prompts under the same entities / settings (opt-in)
+_PAGES_SEMANTIC: SemanticCache[Tuple[List[str], List[str]]] = SemanticCache(
+    "story_pages", PAGES_SEMANTIC_THRESHOLD, ttl=OPENAI_CACHE_TTL
+)
+
+
+@lru_cache(maxsize=256)
+def _format_entities(pairs: Tuple[Tuple[str, Optional[str]], ...]) -> str:
+    return "\n".join(f"- {name}: {prompt or 'image only'}" for name, prompt in pairs) or "(none)"
+
+
+def _entity_descriptions(entities: Optional[Iterable[StoryEntity]]) -> str:
+    """Bullet list of entity names and prompts, memoised on (name, prompt)."""
+    return _format_entities(tuple((e.name, e.prompt) for e in (entities or ())))
+
+
+def _story_pages_messages(story, entities: Optional[Iterable[StoryEntity]] = None) -> List[dict]:
+    """Build the page-writer conversation for *story* and its *entities*."""
     prompt = story.prompt
     
-    ent_desc = "\n".join(
-        f"- {e.name}: {e.prompt or 'image only'}" for e in (entities or [])
-    ) or "(none)"
+    ent_desc = _entity_descriptions(entities)
 
     desired_pages = (
         story.settings.target_page_count
@@ -53,7 +132,7 @@ def _generate_story_pages(story, entities: Optional[List[StoryEntity]] = None) -
             "content": (
             "You are a creative and concise children's story writer. You will receive a short story prompt and a list of reusable story entities (characters or important elements)."
 
-            "Your task is to continue the story by generating a JSON array of short story segments (1–2 sentences each). These will become the pages of a picture book."
+            "Your task is to continue the story by generating a JSON array of short story segments (1–2 sentences each), each paired with a prompt for its illustration. These will become the pages of a picture book."
 
              f"📌 Unless the user explicitly specifies otherwise, generate exactly **{desired_pages}** story pages.\n\n"
 
@@ -65,12 +144,13 @@ def _generate_story_pages(story, entities: Optional[List[StoryEntity]] = None) -
             "- Use the listed entities where relevant, integrating them naturally.\n"
 
             "\n\nImportant formatting rules:\n"
-            "- Return ONLY a valid **JSON array** of strings. Example:\n"
-            "  [\"John picked up a stick.\", \"The dog wagged its tail excitedly.\"]\n"
+            "- Return ONLY a valid **JSON array** of objects with a `text` and an `image_prompt` key. Example:\n"
+            "  [{\"text\": \"John picked up a stick.\", \"image_prompt\": \"A boy holding a stick in a sunny park\"}]\n"
+            "- `image_prompt` is a short visual description of the page's illustration; name the entities that appear in it.\n"
             "- **Do NOT** include any labels like 'Page 1:', 'Page 2:', etc.\n"
             "- **Do NOT** use markdown, quotes, bullets, or code blocks.\n"
             "- **Do NOT** wrap the array in triple backticks or fences.\n"
-            "- **Each array element must be plain story text only.**\n"
+            "- **Each `text` must be plain story text only.**\n"
 
             "\nReusable entities you may use in the story:\n"
             f"{ent_desc or '(none)'}"
@@ -80,65 +160,458 @@ def _generate_story_pages(story, entities: Optional[List[StoryEntity]] = None) -
         {"role": "user", "content": prompt},
     ]
 
-    resp = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=400,
-        temperature=0.7,
-    )
-    raw = resp.choices[0].message.content.strip()
-    return _parse_json_or_lines(raw)
+    return messages
+
+
+async def _stream_story_pages(messages: List[dict]) -> AsyncIterator[Tuple[str, str]]:
+    """Yield `(text, image_prompt)` per page as soon as the model finishes it.
+
+    The completion is streamed and cut into array items on the fly, so the
+    first page is available long before the last token arrives. Replies that
+    are not a JSON array are parsed as a whole once the stream ends.
+    """
+    await chat_limiter.acquire(estimate_tokens(messages, 800))
+    with pause_on_429(chat_limiter):
+        stream = await client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=800,
+            temperature=0.7,
+            stream=True,
+        )
+    scanner = _ArrayItemScanner()
+    chunks: List[str] = []
+    yielded = False
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        chunks.append(delta)
+        for item in scanner.feed(delta):
+            page = _page_from_item(item)
+            if page is not None:
+                yielded = True
+                yield page
+
+    if not yielded:
+        texts, image_prompts = _parse_page_image_pairs("".join(chunks).strip())
+        for pair in zip(texts, image_prompts):
+            yield pair
+
+
+async def _generate_tail(
+    messages: List[dict],
+    texts: List[str],
+    image_prompts: List[str],
+    missing: int,
+) -> Tuple[List[str], List[str]]:
+    """Ask for just the *missing* last pages, continuing the pages so far.
+
+    Much cheaper than regenerating the whole story when the model stopped
+    short; never returns more than *missing* pages.
+    """
+    so_far = orjson.dumps(
+        [{"text": t, "image_prompt": p} for t, p in zip(texts, image_prompts)]
+    ).decode()
+    tail_messages = [
+        *messages,
+        {"role": "assistant", "content": so_far},
+        {
+            "role": "user",
+            "content": (
+                f"Continue the story with exactly {missing} more page(s) that follow on from the last one. "
+                "Return ONLY a JSON array of the new pages, in the same format."
+            ),
+        },
+    ]
+    max_tokens = 200 * missing
+    await chat_limiter.acquire(estimate_tokens(tail_messages, max_tokens))
+    with pause_on_429(chat_limiter):
+        resp = await client.chat.completions.create(
+            model="gpt-4o",
+            messages=tail_messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+        )
+    more_texts, more_prompts = _parse_page_image_pairs(resp.choices[0].message.content.strip())
+    return more_texts[:missing], more_prompts[:missing]
+
+
+async def _top_up_pages(
+    story,
+    entities: Optional[Iterable[StoryEntity]],
+    texts: List[str],
+    image_prompts: List[str],
+    messages: Optional[List[dict]] = None,
+) -> None:
+    """Extend *texts* / *image_prompts* in place up to an explicit
+    `target_page_count`, via `_generate_tail`.
+
+    Longer results are kept as they are: the user may have asked for more
+    pages than the target.
+    """
+    target = story.settings.target_page_count if story.settings else None
+    if not target or not texts or len(texts) >= target:
+        return
+    logger.info("Got %d pages, asking for the missing %d", len(texts), target - len(texts))
+    if messages is None:
+        messages = _story_pages_messages(story, entities)
+    more_texts, more_prompts = await _generate_tail(messages, texts, image_prompts, target - len(texts))
+    if on_page := _page_listener.get():
+        for i, (text, image_prompt) in enumerate(zip(more_texts, more_prompts), len(texts)):
+            on_page(i, text, image_prompt)
+    texts += more_texts
+    image_prompts += more_prompts
+
+
+async def _generate_story_pages(
+    story, entities: Optional[Iterable[StoryEntity]] = None, fresh: bool = False
+) -> Tuple[List[str], List[str]]:
+    """Call OpenAI to expand the prompt into *n* 1‑2 sentence pages.
+
+    Each page comes back together with its illustration prompt, so one call
+    yields both `(texts, image_prompts)` as parallel lists. *fresh* skips the
+    cached and similar earlier results, for an explicit regenerate.
+    """
+    messages = _story_pages_messages(story, entities)
+
+    async def generate() -> Tuple[List[str], List[str]]:
+        vector = None
+        if PAGES_SEMANTIC_THRESHOLD and story.prompt:
+            # The system message carries everything but the prompt
+            context = content_key(messages[0]["content"])
+            vector = await embed(story.prompt)
+            if vector is not None and not fresh and (similar := _PAGES_SEMANTIC.lookup(context, vector)):
+                return similar
+
+        on_page = _page_listener.get()
+        texts: List[str] = []
+        image_prompts: List[str] = []
+        async for text, image_prompt in _stream_story_pages(messages):
+            if on_page:
+                on_page(len(texts), text, image_prompt)
+            texts.append(text)
+            image_prompts.append(image_prompt)
+
+        await _top_up_pages(story, entities, texts, image_prompts, messages)
+        if vector is not None and texts:
+            _PAGES_SEMANTIC.add(context, vector, (texts, image_prompts))
+        return texts, image_prompts
+
+    # The messages embed the prompt, entities, tone and page count
+    key = content_key("gpt-4o", 800, messages)
+    return await _PAGES_CACHE.get_or_compute(key, generate, fresh)
+
+
+_IMAGE_PROMPTS_CACHE: AsyncLRUCache[List[str]] = AsyncLRUCache("image_prompts", maxsize=512, ttl=OPENAI_CACHE_TTL)
+
+
+async def _generate_image_prompts(
+    pages: List[StoryText],
+    entities: Optional[Iterable[StoryEntity]] = None,
+    instructions: Optional[str] = None,
+    fresh: bool = False,
+) -> List[str]:
+    """Write one illustration prompt per page of *pages* in a single call.
+
+    The result is parallel to *pages*; pages the model skipped get "".
+    *fresh* skips a cached result, for an explicit regenerate.
+    """
+    ent_desc = _entity_descriptions(entities)
+    page_list = "\n".join(f"{i + 1}. {p.text}" for i, p in enumerate(pages))
+
+    logger.info("Generating image prompts for %d page(s)", len(pages))
+
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "You write illustration prompts for a children's picture book. "
+                "For every page you receive, write one short visual description of its illustration; "
+                "name the entities that appear in it.\n\n"
+                f"- Return ONLY a valid **JSON array** of exactly {len(pages)} strings, in page order.\n"
+                "- **Do NOT** use markdown, labels, or code fences.\n"
+                + (f"- Follow these instructions: {instructions}\n" if instructions else "")
+                + "\nEntities:\n"
+                f"{ent_desc}"
+            ),
+        },
+        {"role": "user", "content": page_list},
+    ]
+
+    async def generate() -> List[str]:
+        await chat_limiter.acquire(estimate_tokens(messages, 800))
+        with pause_on_429(chat_limiter):
+            resp = await client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=800,
+                temperature=0.7,
+            )
+        return _parse_json_or_lines(resp.choices[0].message.content.strip())
+
+    prompts = await _IMAGE_PROMPTS_CACHE.get_or_compute(content_key("gpt-4o", 800, messages), generate, fresh)
+    return (prompts + [""] * len(pages))[:len(pages)]
 
 
 logger = logging.getLogger("storygpt")
 
+# "1." / "2)" / "3-" list numbering the model sometimes adds in plain-text replies
+_NUMBERING_RE = re.compile(r"^\s*\d+[).\-]?\s*")
+
+def _extract_json_array(s: str) -> Optional[str]:
+    """Return the first balanced `[...]` in *s*, or None if it never closes.
+
+    A single forward scan that tracks nesting depth and skips brackets inside
+    JSON strings – linear time, unlike a greedy regex over the whole reply.
+    """
+    start = s.find("[")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = escape = False
+    for i in range(start, len(s)):
+        ch = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "[":
+            depth += 1
+        elif ch == "]":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
+
+
+class _ArrayItemScanner:
+    """Cut complete top-level items out of a JSON array that arrives in chunks.
+
+    Same string/escape-aware depth tracking as `_extract_json_array`, but the
+    state survives between `feed` calls. Anything before the opening `[`
+    (e.g. a code fence) is skipped.
+    """
+
+    def __init__(self) -> None:
+        self._item: List[str] = []
+        self._depth = 0                  # 0 = before the array, 1 = top level
+        self._in_string = self._escape = False
+        self.closed = False
+
+    def feed(self, chunk: str) -> List[str]:
+        """Consume *chunk*; return the raw JSON of every item it completed."""
+        items: List[str] = []
+        for ch in chunk:
+            if self.closed:
+                break
+            if self._depth == 0:
+                if ch == "[":
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self._depth += 1
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth == 0:     # the array itself closed
+                    self.closed = True
+                    self._flush(items)
+                    break
+            elif ch == "," and self._depth == 1:
+                self._flush(items)
+                continue
+            self._item.append(ch)
+        return items
+
+    def _flush(self, items: List[str]) -> None:
+        item = "".join(self._item).strip()
+        self._item.clear()
+        if item:
+            items.append(item)
+
+
+def _page_from_item(item: str) -> Optional[Tuple[str, str]]:
+    """`{"text", "image_prompt"}` (or a bare string) → `(text, image_prompt)`."""
+    try:
+        data = orjson.loads(item)
+    except orjson.JSONDecodeError:
+        logger.warning("Skipping unparsable page item: %.60s", item)
+        return None
+    if isinstance(data, str):
+        data = {"text": data}
+    if not isinstance(data, dict):
+        return None
+    text = str(data.get("text") or "").strip()
+    if not text:
+        return None
+    return text, str(data.get("image_prompt") or "").strip()
+
+
 def _clean_json_fence(raw: str) -> str:
-    cleaned = re.sub(r"```\w*", "", raw).strip()
-    match = re.search(r"\[.*]", cleaned, re.S)
-    return match.group(0).strip() if match else cleaned
+    cleaned = raw.strip()
+    if cleaned.startswith("```"):
+        # Drop the opening fence line (e.g. ```json) and the closing fence
+        newline = cleaned.find("\n")
+        cleaned = cleaned[newline + 1:] if newline >= 0 else ""
+        cleaned = cleaned.rstrip()
+        if cleaned.endswith("```"):
+            cleaned = cleaned[:-3]
+        cleaned = cleaned.strip()
+    array = _extract_json_array(cleaned)
+    return array if array is not None else cleaned
+
+
+def _looks_complete(cleaned: str) -> bool:
+    """Cheap probe: only a buffer ending in `]` or `}` can be valid JSON here."""
+    return cleaned.rstrip()[-1:] in ("]", "}")
+
+
+def _fallback_split(cleaned: str) -> List[str]:
+    """Naive line splitting for responses that are not a JSON list."""
+    return [
+        _NUMBERING_RE.sub("", s).strip()
+        for ln in cleaned.splitlines()
+        if (s := ln.strip()) and s not in ("[", "]")
+    ]
 
 
 def _parse_json_or_lines(text: str) -> List[str]:
     cleaned = _clean_json_fence(text)
-    print("parsing")
+    logger.debug("Parsing %d chars of model output", len(cleaned))
+    if not _looks_complete(cleaned):
+        logger.warning("Response is not a complete JSON value; splitting lines")
+        return _fallback_split(cleaned)
+
     try:
-        data = json.loads(cleaned)
-        if isinstance(data, dict) and "pages" in data:
-            data = data["pages"]
-        if isinstance(data, list) and all(isinstance(x, str) for x in data):
-            return [x.strip() for x in data if x.strip()]
-        raise ValueError("Parsed JSON is not a list of strings.")
-    except Exception as e:
+        data = orjson.loads(cleaned)
+    except orjson.JSONDecodeError as e:
         logger.warning("Failed to parse JSON properly: %s", e)
-        # Fallback: naive line splitting
-        return [
-            re.sub(r"^\s*\d+[).\-]?\s*", "", ln).strip()
-            for ln in cleaned.splitlines()
-            if ln.strip() and ln.strip() not in {"[", "]"}
-        ]
+        return _fallback_split(cleaned)
 
+    if isinstance(data, dict) and "pages" in data:
+        data = data["pages"]
+    if isinstance(data, list) and all(isinstance(x, str) for x in data):
+        return [s for x in data if (s := x.strip())]
+    logger.warning("Parsed JSON is not a list of strings; splitting lines")
+    return _fallback_split(cleaned)
 
-def _normalize_indexes(story: Story) -> None:
-    for i, pg in enumerate(story.pages):
-        pg.index = i
 
-def _find_entity(name: str, entities: List[StoryEntity]) -> Optional[StoryEntity]:
-    return next((e for e in entities if e.name == name), None)
+def _parse_page_image_pairs(text: str) -> Tuple[List[str], List[str]]:
+    """Split `[{"text": …, "image_prompt": …}, …]` into `(texts, image_prompts)`.
+
+    Any other shape falls back to `_parse_json_or_lines`, with empty prompts.
+    """
+    cleaned = _clean_json_fence(text)
+    data = None
+    if _looks_complete(cleaned):
+        try:
+            data = orjson.loads(cleaned)
+        except orjson.JSONDecodeError:
+            pass
+
+    if isinstance(data, list) and data and all(isinstance(x, dict) for x in data):
+        texts: List[str] = []
+        image_prompts: List[str] = []
+        for item in data:
+            page = str(item.get("text") or "").strip()
+            if page:
+                texts.append(page)
+                image_prompts.append(str(item.get("image_prompt") or "").strip())
+        return texts, image_prompts
 
-def _summarise_images(images) -> str:
-    """Return a short bulleted list of the page images, omitting b64 data."""
+    texts = _parse_json_or_lines(text)
+    return texts, [""] * len(texts)
+
+
+def _normalize_indexes(story: Story, start: int = 0, stop: Optional[int] = None) -> None:
+    """Renumber `story.pages[start:stop]`; pages outside that slice did not move.
+
+    Writes `__dict__` directly – this is bookkeeping on our own models, so
+    there is nothing for pydantic's `__setattr__` to check.
+    """
+    pages = story.pages
+    for i in range(start, len(pages) if stop is None else stop):
+        pg = pages[i]
+        pg.__dict__["index"] = i
+        pg.__pydantic_fields_set__.add("index")
+
+def _set_page_texts(story: Story, texts: List[str]) -> None:
+    """Make `story.pages` hold *texts*, reusing the existing page objects.
+
+    Pages beyond the old count are built with `model_construct` (the texts are
+    ours, no validation needed); surplus pages are dropped.
+    """
+    pages = story.pages
+    for i, t in enumerate(texts):
+        if i < len(pages):
+            pages[i].index = i
+            pages[i].text = t
+        else:
+            pages.append(StoryText.model_construct(index=i, text=t))
+    del pages[len(texts):]
+
+def _ensure_image_slot(story: Story, idx: int) -> None:
+    """Grow `story.images` with empty slots so that `idx` is addressable."""
+    n = len(story.images)
+    if n <= idx:
+        story.images += [None] * (idx + 1 - n)
+
+def _summarise_pages(pages, max_chars: int = 200) -> str:
+    """Return one line per page with its text cut to *max_chars*."""
+    if not pages:
+        return "(none)"
+    lines = []
+    for page in pages:
+        text = page.text if len(page.text) <= max_chars else page.text[:max_chars] + "…"
+        lines.append(f"- page {page.index}: {text}")
+    return "\n".join(lines)
+
+
+def _summarise_images(images, limit: int = 5) -> str:
+    """Return a short bulleted list of the page images, omitting b64 data.
+
+    Only the first *limit* images are listed; the rest are counted.
+    """
     if not images:
         return "(none)"
+    present = [img for img in images if img is not None]   # skip holes
     lines = []
-    for img in images:
-        if img is None:           # hole in the list
-            continue
-        snippet = (img.prompt or "")[:60]            # first 60 chars
-        if len(snippet) < len(img.prompt or ""):
-            snippet += "…"
+    for img in present[:limit]:
+        p = img.prompt or ""
+        snippet = p[:60] + ("…" if len(p) > 60 else "")   # first 60 chars
         lines.append(
             f"- page {img.index}: size={img.size or '?'} "
             f"quality={img.quality or '?'} • prompt: {snippet}"
         )
+    if len(present) > limit:
+        lines.append(f"- … {len(present) - limit} more")
     return "\n".join(lines)
 
+
+def _story_images_summary(story: Story) -> str:
+    """`_summarise_images(story.images)`, reused until the images change.
+
+    Both agents summarise the same story in one turn; unless an image tool
+    ran in between (see `Story.touch_images`) the second call is free.
+    """
+    cached = story._images_summary
+    if cached is not None and cached[0] == story._images_version:
+        return cached[1]
+    summary = _summarise_images(story.images)
+    story._images_summary = (story._images_version, summary)
+    return summary
+
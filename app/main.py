@@ -1,17 +1,78 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 from app.routers import comic_routers
 from app.routers import fake_comic_routers
 from dotenv import load_dotenv
 import os
+from anyio import to_thread
 from app.utils.logger import logger
+from app.features.story_chat.core.image_cache import init_image_cache
+from app.features.story_chat.config import client, image_http_client, start_log_listener, stop_log_listener, MAX_REQUEST_BYTES
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import JSONResponse
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize the FastAPI app
-app = FastAPI()
+# AnyIO worker threads per process; default is 40. Every chunk read of an
+# /images/{uid} download (FileResponse) and every image store / cache write
+# takes one, so many parallel image downloads would otherwise queue behind it.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Log writes happen on the listener thread, off the request path
+    start_log_listener()
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await to_thread.run_sync(init_image_cache)
+    yield
+    # Release pooled connections on shutdown
+    await image_http_client.aclose()
+    await client.close()
+    stop_log_listener()       # flushes whatever is still queued
+
+# Initialize the FastAPI app. Routes with a response_model are serialised
+# straight to JSON bytes by pydantic-core, so no custom response class is needed.
+app = FastAPI(lifespan=lifespan)
+
+class ChatBodyLimit:
+    """Refuse oversized /chat bodies before they are read and validated.
+
+    A too-large `Content-Length` is refused up front; bodies without one
+    (chunked) are counted as they arrive and cut off once over the limit.
+    Plain ASGI: other routes (the image uploads) are not limited, and
+    responses – including the /chat/stream event stream – pass through as-is.
+    """
+
+    PATHS = {"/chat", "/chat/stream"}
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.PATHS:
+            return await self.app(scope, receive, send)
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > MAX_REQUEST_BYTES:
+                response = JSONResponse({"detail": "Request body too large."}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_REQUEST_BYTES:
+                    # Re-raised by FastAPI's body parsing and answered as a 413
+                    raise HTTPException(413, "Request body too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(ChatBodyLimit)
 
 # Include application routers
 app.include_router(comic_routers.router)
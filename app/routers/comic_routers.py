@@ -1,4 +1,5 @@
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, Header, Response
 from app.controllers.analyze_image_url_controller import analyze_image_url_controller
 from app.controllers.analyze_image_base64_controller import analyze_image_base64_controller
 from app.controllers.generate_story_text_controller import generate_story_text_controller
@@ -6,7 +7,7 @@ from app.controllers.generate_image_controller import generate_image_controller
 
 from app.schemas.comic_schemas import ComicRequest, ImageRequest, ImageUrlRequest, Base64ImageRequest
 
-from app.features.story_chat.controller import handle_chat
+from app.features.story_chat.controller import handle_chat, handle_chat_stream, handle_get_image
 from app.features.story_chat.core.schemas import ChatRequest, ChatResponse  # Assuming you moved the schemas
  
 
@@ -29,5 +30,13 @@ async def generate_image(request: ImageRequest):
     return await generate_image_controller(request)
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
-    return await handle_chat(req)
+async def chat(req: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    return await handle_chat(req, response, idempotency_key)
+
+@router.post("/chat/stream")
+async def chat_stream(req: ChatRequest, idempotency_key: Optional[str] = Header(None)):
+    return await handle_chat_stream(req, idempotency_key)
+
+@router.get("/images/{uid}")
+async def get_image(uid: str):
+    return await handle_get_image(uid)
@@ -0,0 +1,8 @@
+import os
+
+from dotenv import load_dotenv
+
+# The OpenAI client is built at import time and needs a key. Unit tests never
+# call the API, so a placeholder is enough; a real key from .env still wins.
+load_dotenv()
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from app.features.story_chat.core.utils import _ArrayItemScanner, _page_from_item
+
+
+def scan(text, chunk_size=None):
+    scanner = _ArrayItemScanner()
+    if chunk_size is None:
+        return scanner.feed(text), scanner
+    items = []
+    for start in range(0, len(text), chunk_size):
+        items += scanner.feed(text[start:start + chunk_size])
+    return items, scanner
+
+
+PAGES = [
+    {"text": "Rex said \"hi\", then left.", "image_prompt": "a dog [waving]"},
+    {"text": "A {curly} day, a \\ backslash", "image_prompt": "sun, clouds"},
+    {"text": "Last page", "image_prompt": ""},
+]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 2, 7, 64])
+def test_items_survive_any_chunking(chunk_size):
+    items, scanner = scan(json.dumps(PAGES), chunk_size)
+    assert [json.loads(i) for i in items] == PAGES
+    assert scanner.closed
+
+
+def test_skips_a_code_fence_before_the_array():
+    items, _ = scan('```json\n["a", "b"]\n```')
+    assert items == ['"a"', '"b"']
+
+
+def test_brackets_commas_and_quotes_inside_strings():
+    text = r'["x, [y] {z}", "say \"]\" now", "end"]'
+    items, _ = scan(text, 3)
+    assert [json.loads(i) for i in items] == ["x, [y] {z}", 'say "]" now', "end"]
+
+
+def test_escaped_backslash_before_a_closing_quote():
+    text = r'["a\\", "b"]'
+    items, _ = scan(text, 1)
+    assert [json.loads(i) for i in items] == ["a\\", "b"]
+
+
+def test_nested_arrays_and_objects_stay_one_item():
+    value = [{"a": [1, [2, 3]], "b": {"c": [4]}}, [5, {"d": 6}]]
+    items, _ = scan(json.dumps(value), 5)
+    assert [json.loads(i) for i in items] == value
+
+
+def test_stops_at_the_closing_bracket():
+    items, scanner = scan('["a"] trailing ["b"]')
+    assert items == ['"a"']
+    assert scanner.closed
+    assert scanner.feed('["c"]') == []
+
+
+def test_unterminated_array_keeps_the_partial_item():
+    items, scanner = scan('["a", "b')
+    assert items == ['"a"']
+    assert not scanner.closed
+
+
+@pytest.mark.parametrize("text, expected", [("[]", []), ("[ ]", []), ('["a",]', ['"a"'])])
+def test_empty_items_are_dropped(text, expected):
+    items, _ = scan(text)
+    assert items == expected
+
+
+def test_page_from_item():
+    assert _page_from_item('{"text": "t", "image_prompt": "p"}') == ("t", "p")
+    assert _page_from_item('"just text"') == ("just text", "")
+    assert _page_from_item("{not json") is None
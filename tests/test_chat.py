@@ -56,6 +56,8 @@ def print_assistant(resp: Dict[str, Any]) -> None:
         extra_lines.append(f"Modes: {', '.join(modes)}")
     if resp.get("image_b64"):
         extra_lines.append("[image base64 omitted]")
+    if resp.get("image_url"):
+        extra_lines.append(f"Image: {resp['image_url']}")
 
     footer = "\n".join(extra_lines)
 
@@ -0,0 +1,104 @@
+import pytest
+
+from app.features.story_chat.core.entity_store import EntityStore
+from app.features.story_chat.core.schemas import StoryEntity
+
+
+def names(store):
+    return [e.name for e in store]
+
+
+@pytest.fixture
+def store():
+    return EntityStore([StoryEntity(name="Rex"), StoryEntity(name="Mia"), StoryEntity(name="Tom")])
+
+
+def test_lookup_by_name(store):
+    assert store.get("Mia").name == "Mia"
+    assert "Tom" in store and store.has("Tom")
+    assert store.get("Nobody") is None
+    assert len(store) == 3
+
+
+def test_adopts_the_request_list_in_place():
+    entities = [StoryEntity(name="Rex")]
+    store = EntityStore(entities)
+    store.add(StoryEntity(name="Mia"))
+    assert store.items is entities
+    assert names(entities) == ["Rex", "Mia"]
+
+
+def test_delete_leaves_a_hole_until_items_is_read(store):
+    store.delete(store.get("Mia"))
+    assert len(store) == 2
+    assert not store.has("Mia")
+    assert names(store) == ["Rex", "Tom"]
+    assert None in store._items              # tombstone, not yet compacted
+    assert names(store.items) == ["Rex", "Tom"]
+    assert None not in store._items
+
+
+def test_delete_after_compaction_uses_the_new_positions(store):
+    store.delete(store.get("Rex"))
+    store.items                               # compacts, Tom moves from slot 2 to 1
+    store.delete(store.get("Tom"))
+    assert names(store.items) == ["Mia"]
+
+
+def test_add_after_delete_keeps_order(store):
+    store.delete(store.get("Rex"))
+    store.add(StoryEntity(name="Ann"))
+    assert names(store.items) == ["Mia", "Tom", "Ann"]
+    assert store.get("Ann").name == "Ann"
+
+
+def test_rename_moves_the_name(store):
+    rex = store.get("Rex")
+    store.rename(rex, "Max")
+    assert not store.has("Rex")
+    assert store.get("Max") is rex
+    assert names(store.items) == ["Max", "Mia", "Tom"]
+
+
+def test_duplicate_names_resolve_to_the_first():
+    first, second = StoryEntity(name="Rex", prompt="1"), StoryEntity(name="Rex", prompt="2")
+    store = EntityStore([first, second])
+    assert store.get("Rex") is first
+    assert len(store) == 2
+
+
+def test_deleting_a_duplicate_falls_back_to_the_next():
+    first, second = StoryEntity(name="Rex", prompt="1"), StoryEntity(name="Rex", prompt="2")
+    store = EntityStore([first, second])
+    store.delete(first)
+    assert store.get("Rex") is second
+    store.delete(second)
+    assert not store.has("Rex")
+    assert store.items == []
+
+
+def test_deleting_the_later_duplicate_keeps_the_first():
+    first, second = StoryEntity(name="Rex", prompt="1"), StoryEntity(name="Rex", prompt="2")
+    store = EntityStore([first, second])
+    store.delete(second)
+    assert store.get("Rex") is first
+    store.delete(first)
+    assert not store.has("Rex")
+
+
+def test_renaming_a_duplicate_falls_back_to_the_next():
+    first, second = StoryEntity(name="Rex", prompt="1"), StoryEntity(name="Rex", prompt="2")
+    store = EntityStore([first, second])
+    store.rename(first, "Max")
+    assert store.get("Rex") is second
+    assert store.get("Max") is first
+    store.delete(second)
+    assert not store.has("Rex")
+
+
+def test_renaming_onto_a_taken_name_keeps_the_existing_entry(store):
+    mia, rex = store.get("Mia"), store.get("Rex")
+    store.rename(rex, "Mia")
+    assert store.get("Mia") is mia
+    store.delete(mia)
+    assert store.get("Mia") is rex
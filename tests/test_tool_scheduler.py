@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.features.story_chat import controller
+from app.features.story_chat.core.entity_store import EntityStore
+from app.features.story_chat.core.schemas import Story
+
+# Fake tools: name → (reads, writes, seconds it takes)
+TOOLS = {
+    "slow_write_a":  ({"a"}, {"a"}, 0.05),
+    "fast_write_a":  ({"a"}, {"a"}, 0.0),
+    "read_a":        ({"a"}, set(), 0.0),
+    "write_b":       (set(), {"b"}, 0.05),
+    "write_c":       (set(), {"c"}, 0.05),
+}
+
+
+@pytest.fixture
+def events(monkeypatch):
+    log = []
+
+    def resources(tool, data):
+        reads, writes, _ = TOOLS[tool]
+        return frozenset(reads), frozenset(writes)
+
+    async def apply(tool, data, story, entities):
+        log.append(("start", data["id"]))
+        try:
+            if data.get("fail"):
+                raise HTTPException(400, "bad call")
+            await asyncio.sleep(TOOLS[tool][2])
+        except asyncio.CancelledError:
+            log.append(("cancelled", data["id"]))
+            raise
+        log.append(("end", data["id"]))
+        return {"id": data["id"]}
+
+    monkeypatch.setattr(controller, "_tool_resources", resources)
+    monkeypatch.setattr(controller, "_apply_tool", apply)
+    return log
+
+
+def run(calls):
+    return asyncio.run(controller._run_tool_calls(calls, Story(), EntityStore()))
+
+
+def test_results_come_back_in_call_order(events):
+    results = run([("write_b", {"id": 1}), ("fast_write_a", {"id": 2})])
+    assert results == [{"id": 1}, {"id": 2}]
+
+
+def test_conflicting_calls_keep_the_model_order(events):
+    run([("slow_write_a", {"id": 1}), ("fast_write_a", {"id": 2}), ("read_a", {"id": 3})])
+    assert events == [
+        ("start", 1), ("end", 1),
+        ("start", 2), ("end", 2),
+        ("start", 3), ("end", 3),
+    ]
+
+
+def test_independent_calls_overlap(events):
+    run([("write_b", {"id": 1}), ("write_c", {"id": 2})])
+    assert events[:2] == [("start", 1), ("start", 2)]
+
+
+def test_a_failing_call_cancels_and_awaits_the_rest(events):
+    with pytest.raises(HTTPException):
+        run([("write_b", {"id": 1}), ("fast_write_a", {"id": 2, "fail": True}), ("read_a", {"id": 3})])
+    # The running call was cancelled (and finished cancelling) before the
+    # error surfaced; the dependent call never started
+    assert ("cancelled", 1) in events
+    assert ("end", 1) not in events
+    assert ("start", 3) not in events